@@ -9,16 +9,43 @@ printf "Running snakemake...\n"
 
 mkdir -p logs
 
+# Report-first mode ("reportFirst" in config.json): the analyses generate_report
+# reads, across all genes, get the free job slots before the exploratory
+# variants; the report is rewritten as *.final.json when everything is done
+PRIORITIZE=""
+if [ "$(python3 -c "import json; print(json.load(open('config.json')).get('reportFirst', 'true'))")" = "true" ]; then
+    PRIORITIZE="--prioritize generate_report"
+fi
+
+# ppn and memory follow each job's threads / mem_mb (results/<label>/<gene>.resources.json
+# for raxml-ng and HyPhy); --stats records the makespan, compare two runs with
+#   python3 scripts/resource_plan.py --compare logs/stats.<before>.json logs/stats.<after>.json
 snakemake \
       -s Snakefile \
       --cluster-config cluster.json \
-      --cluster "qsub -V -l nodes={cluster.nodes}:ppn={cluster.ppn} -q {cluster.name} -l walltime=72:00:00 -e logs -o logs" \
+      --cluster "qsub -V -l nodes={cluster.nodes}:ppn={threads} -l mem={resources.mem_mb}mb -q {cluster.name} -l walltime=72:00:00 -e logs -o logs" \
+      --default-resources \
+      --stats logs/stats.$(date +%Y%m%d_%H%M%S).json \
       --jobs 10 all \
+      $PRIORITIZE \
       --rerun-incomplete \
       --keep-going \
       --reason \
-      --latency-wait 60 
-
-
-
-exit 0
+      --latency-wait 60 \
+      || status=$?
+
+# --keep-going: the post-run steps below run whatever the outcome, neither
+# stops the other, and the snakemake exit status is returned at the end
+# Fold this run's benchmarks into the runtime history that decides which
+# analyses are grouped into one job per gene next time
+LABEL=$(python3 -c "import json; print(json.load(open('config.json'))['label'])")
+HISTORY=$(python3 -c "import json; print(json.load(open('config.json')).get('runtimeHistory', 'cache/runtime_history.tsv'))")
+python3 scripts/runtime_history.py --benchmarks benchmarks/"$LABEL" --history "$HISTORY" \
+      || printf "Runtime history not updated\n"
+
+# Progress and age of the checkpoints of the long multi-hit analyses
+CHECKPOINTS=$(python3 -c "import json; print(json.load(open('config.json')).get('checkpointDir', 'cache/checkpoints'))")
+python3 scripts/hyphy_checkpoint.py --summary "$CHECKPOINTS"/"$LABEL" \
+      || printf "No checkpoint summary\n"
+
+exit ${status:-0}
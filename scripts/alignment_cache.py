@@ -0,0 +1,241 @@
+# Persistent per-gene cache of final (in-frame, stop-stripped, ambiguity-struck) codon alignment rows
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+from fasta_io import read_fasta, write_fasta, first_record_name
+from dedup import sequence_hash
+
+# Declares
+# Bump when the bealign -> codon_pipeline.py chain changes what it writes for
+# the same input, this invalidates every cached row
+CACHE_VERSION = "2"
+
+# Query and background of a gene share one database and may run at the same
+# time, possibly on NFS: wait this long for a lock, then retry the whole
+# transaction a few times before going on without the cache
+BUSY_TIMEOUT_S = 600
+RETRIES = 5
+
+# Sequences bealign could not align are stored with an empty row, so they are
+# not sent to the aligner again
+FAILED = ""
+
+# Helper functions -----------------------------------------------------
+
+def retry (db, action, what):
+    # ACTION's result, or None when the database stayed locked / unavailable
+    for attempt in range (RETRIES):
+        try:
+            return action ()
+        except sqlite3.OperationalError as error:
+            db.rollback ()
+            print("# Alignment cache %s failed (%s), attempt %d of %d" % (what, error, attempt + 1, RETRIES))
+            time.sleep (min (60, 2 ** attempt))
+        #end try
+    #end for
+    return None
+#end method
+
+def open_cache (cache_file):
+    os.makedirs (os.path.dirname (os.path.abspath (cache_file)), exist_ok = True)
+    db = sqlite3.connect (cache_file, timeout = BUSY_TIMEOUT_S)
+    def create ():
+        db.execute ("PRAGMA busy_timeout = %d" % (BUSY_TIMEOUT_S * 1000))
+        db.execute ("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        db.execute ("CREATE INDEX IF NOT EXISTS rows_last_used ON rows (last_used)")
+        db.commit ()
+        return True
+    #end nested method
+    if retry (db, create, "open") is None:
+        print("# Alignment cache %s is unavailable" % cache_file)
+        sys.exit(1)
+    #end if
+    return db
+#end method
+
+def reference_hash (reference_file):
+    return sequence_hash ("".join (seq for seq_id, seq in read_fasta (reference_file)))
+#end method
+
+def cache_key (seq, ref_hash, matrix):
+    return hashlib.blake2b (("%s:%s:%s:%s" % (CACHE_VERSION, sequence_hash (seq), ref_hash, matrix)).encode (), digest_size = 16).hexdigest ()
+#end method
+
+def requested_records (in_file, reference_file, keep_reference):
+    # Records in the order the serial bealign path writes them
+    if keep_reference:
+        ref_id = first_record_name (reference_file)
+        for seq_id, seq in read_fasta (reference_file):
+            yield ref_id, seq
+            break
+        #end for
+    #end if
+    for seq_id, seq in read_fasta (in_file):
+        yield seq_id, seq
+    #end for
+#end method
+
+def lookup (db, in_file, reference_file, matrix, keep_reference, uncached_file, cached_file):
+    ref_hash = reference_hash (reference_file)
+    records = [(seq_id, seq, cache_key (seq, ref_hash, matrix)) for seq_id, seq in requested_records (in_file, reference_file, keep_reference)]
+    now = time.time ()
+    def fetch ():
+        rows = {}
+        for key in set (key for seq_id, seq, key in records):
+            row = db.execute ("SELECT row FROM rows WHERE key = ?", (key,)).fetchone ()
+            if row is not None:
+                rows[key] = row[0]
+            #end if
+        #end for
+        db.executemany ("UPDATE rows SET last_used = ? WHERE key = ?", [(now, key) for key in rows])
+        db.commit ()
+        return rows
+    #end nested method
+    rows = retry (db, fetch, "lookup")
+    if rows is None:
+        print("# Alignment cache unavailable, aligning every sequence")
+        rows = {}
+    #end if
+
+    hits = misses = failed = 0
+    with open (uncached_file, "w") as unc, open (cached_file, "w") as cac:
+        for seq_id, seq, key in records:
+            row = rows.get (key)
+            if row is None:
+                misses += 1
+                write_fasta (unc, seq_id, seq)
+            elif row == FAILED:
+                # dropped again, as the aligner would
+                failed += 1
+            else:
+                hits += 1
+                write_fasta (cac, seq_id, row)
+            #end if
+        #end for
+        if misses == 0:
+            # bealign needs at least one record, the reference always aligns and
+            # is dropped again at assembly unless it was requested
+            for seq_id, seq in read_fasta (reference_file):
+                write_fasta (unc, first_record_name (reference_file), seq)
+                break
+            #end for
+        #end if
+    #end with
+    return hits, misses, failed
+#end method
+
+def evict (db, max_bytes):
+    total = db.execute ("SELECT COALESCE(SUM(size), 0) FROM rows").fetchone ()[0]
+    evicted = 0
+    if total <= max_bytes:
+        return evicted
+    #end if
+    for key, size in db.execute ("SELECT key, size FROM rows ORDER BY last_used ASC").fetchall ():
+        if total <= max_bytes:
+            break
+        #end if
+        db.execute ("DELETE FROM rows WHERE key = ?", (key,))
+        total -= size
+        evicted += 1
+    #end for
+    db.commit ()
+    return evicted
+#end method
+
+def assemble (db, in_file, reference_file, matrix, keep_reference, fresh_file, cached_file, out_file, max_bytes):
+    ref_hash = reference_hash (reference_file)
+    fresh = dict (read_fasta (fresh_file))
+    cached = dict (read_fasta (cached_file))
+    written = dropped = 0
+    now = time.time ()
+    inserts = []
+    with open (out_file, "w") as fh:
+        for seq_id, seq in requested_records (in_file, reference_file, keep_reference):
+            if seq_id in cached:
+                row = cached[seq_id]
+            elif seq_id in fresh:
+                row = fresh[seq_id]
+                inserts.append ((cache_key (seq, ref_hash, matrix), row, len (row) + len (seq_id), now))
+            else:
+                # Not written by the aligner (could not be aligned, or a known
+                # failure from the cache), same as the serial path. With no
+                # aligned rows at all bealign itself went wrong, so nothing
+                # is recorded as a failure.
+                if fresh:
+                    inserts.append ((cache_key (seq, ref_hash, matrix), FAILED, len (seq_id), now))
+                #end if
+                dropped += 1
+                continue
+            #end if
+            write_fasta (fh, seq_id, row)
+            written += 1
+        #end for
+    #end with
+    def store ():
+        db.executemany ("INSERT OR REPLACE INTO rows (key, row, size, last_used) VALUES (?, ?, ?, ?)", inserts)
+        db.commit ()
+        return evict (db, max_bytes)
+    #end nested method
+    evicted = retry (db, store, "update")
+    if evicted is None:
+        print("# Alignment cache not updated, the assembled alignment is complete")
+        return written, 0, dropped, 0
+    #end if
+    return written, len (inserts), dropped, evicted
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Reuse final codon alignment rows across runs')
+    arguments.add_argument('mode', choices = ['lookup', 'assemble'], help = 'lookup: split input into cached rows and sequences to align; assemble: merge cached and freshly aligned rows')
+    arguments.add_argument('-i', '--input',          help = 'Unaligned FASTA (the segment shard)',                    required = True, type = str)
+    arguments.add_argument('-r', '--reference',      help = 'Reference gene FASTA given to bealign',                  required = True, type = str)
+    arguments.add_argument('-c', '--cache',          help = 'Per-gene cache database',                                required = True, type = str)
+    arguments.add_argument('-m', '--matrix',         help = 'bealign scoring matrix',                                 required = False, type = str, default = "HIV_BETWEEN_F")
+    arguments.add_argument('-K', '--keep_reference', help = 'The alignment also carries the reference (bealign -K)',   action = 'store_true')
+    arguments.add_argument('-u', '--uncached',       help = 'FASTA of sequences that still need aligning (lookup)',   required = False, type = str)
+    arguments.add_argument('-a', '--cached',         help = 'FASTA of aligned rows served from the cache',            required = True, type = str)
+    arguments.add_argument('-f', '--fresh',          help = 'Aligned rows for the uncached sequences (assemble)',     required = False, type = str)
+    arguments.add_argument('-o', '--output',         help = 'Assembled alignment (assemble)',                         required = False, type = str)
+    arguments.add_argument('--max_mb',               help = 'Evict least recently used rows above this size',        required = False, type = float, default = 2048)
+    arguments.add_argument('--report',               help = 'Write hit-rate statistics to this json file',            required = False, type = str)
+    settings = arguments.parse_args()
+
+    db = open_cache (settings.cache)
+
+    if settings.mode == 'lookup':
+        if not settings.uncached:
+            print ("lookup needs --uncached")
+            sys.exit(1)
+        #end if
+        hits, misses, failed = lookup (db, settings.input, settings.reference, settings.matrix, settings.keep_reference, settings.uncached, settings.cached)
+        total = max (hits + misses + failed, 1)
+        print("# Alignment cache: %d hits, %d misses, %d known alignment failures (%.1f%% hit rate)" % (hits, misses, failed, 100. * (hits + failed) / total))
+        if settings.report:
+            with open (settings.report, "w") as fh:
+                json.dump ({'cache': settings.cache, 'hits': hits, 'misses': misses, 'failed': failed, 'hit rate': (hits + failed) / total}, fh, indent = 1)
+            #end with
+        #end if
+    else:
+        if not settings.fresh or not settings.output:
+            print ("assemble needs --fresh and --output")
+            sys.exit(1)
+        #end if
+        written, stored, dropped, evicted = assemble (db, settings.input, settings.reference, settings.matrix, settings.keep_reference,
+                                                      settings.fresh, settings.cached, settings.output, settings.max_mb * 1e6)
+        print("# Assembled %d rows, %d newly cached (including failures), %d not aligned, %d evicted" % (written, stored, dropped, evicted))
+    #end if
+
+    db.close ()
+    sys.exit(0)
+#end if
+
+# End of file
@@ -0,0 +1,174 @@
+# Reroot the combined ML tree on the reference and write HyPhy branch-set trees
+# (.int.nwk, .clade.nwk, .full.nwk) and .labels.json, as annotator.bf did
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+
+import newick
+from fasta_io import read_fasta
+
+# Declares
+# Leaves outside the query, the reference included, are tagged with this, as
+# annotator.bf does; RELAX (--reference) and Contrast-FEL (--branch-set) name it
+REFERENCE_LABEL = "Reference"
+
+# Helper functions -----------------------------------------------------
+
+def reroot_on (root, name):
+    # annotator.bf: RerootTree on NAME, then read back unrooted (T) and rooted
+    # (TR). T hangs from the parent of NAME; TR splits that node into NAME and
+    # a clade with the remaining children.
+    target = next ((leaf for leaf in newick.leaves (root) if leaf.name == name), None)
+    if target is None:
+        print("# %s is not in the tree, keeping the input rooting" % name)
+        return root, root
+    #end if
+    root = newick.reroot (root, target.parent)
+    # TR shares the nodes of T; only the two new nodes point at their parents,
+    # so labeling T is unaffected
+    rooted = newick.Node ()
+    clade = newick.Node ("", 0. if target.length is not None else None, rooted)
+    clade.children = [c for c in root.children if c is not target]
+    rooted.children = [target, clade]
+    return root, rooted
+#end method
+
+def name_internal (root):
+    # Internal nodes as NodeN, the convention HyPhy uses for unnamed nodes
+    k = 0
+    for node in newick.postorder (root):
+        if node.children and not node.name:
+            k += 1
+            node.name = "Node%d" % k
+        #end if
+    #end for
+#end method
+
+def parsimony_labels (root, leaf_labels):
+    # Sankoff parsimony with unit change cost over the leaf labels, as
+    # trees.ParsimonyLabel in annotator.bf. Tracing back, ties keep the
+    # parent's label, and at the root go to REFERENCE_LABEL.
+    order = newick.postorder (root)
+    states = sorted (set (leaf_labels.values ()) | {REFERENCE_LABEL})
+    cost = {}
+    for node in order:
+        if node.is_leaf ():
+            leaf = leaf_labels.get (node.name, REFERENCE_LABEL)
+            cost[node] = dict ((state, 0 if state == leaf else float ('inf')) for state in states)
+        else:
+            cost[node] = dict ((state, sum (min (cost[child][other] + (other != state) for other in states) for child in node.children)) for state in states)
+        #end if
+    #end for
+    labels = {}
+    for node in reversed (order):
+        parent = labels[node.parent] if node.parent is not None else REFERENCE_LABEL
+        change = 0 if node.parent is None else 1
+        labels[node] = min (states, key = lambda state: (cost[node][state] + change * (state != parent), state != parent))
+    #end for
+    return labels
+#end method
+
+def annotate (tree_file, reference, query_file, label, prefix, lengths = False):
+    root = newick.read (tree_file)
+    query = set (seq_id for seq_id, seq in read_fasta (query_file))
+    leaf_labels = dict ((leaf.name, label if leaf.name in query else REFERENCE_LABEL) for leaf in newick.leaves (root))
+
+    unrooted, rooted = reroot_on (root, reference)
+    name_internal (rooted)
+    labels = parsimony_labels (unrooted, leaf_labels)
+    def tag (node):
+        # the extra node of the rooted tree has no label, as in annotator.bf
+        return newick.quote (node.name) + ("{%s}" % labels[node] if node in labels else "")
+    #end nested method
+    def internal_tag (node):
+        return tag (node) if node.children else newick.quote (node.name)
+    #end nested method
+
+    with open (prefix + "labels.json", "w") as fh:
+        json.dump (leaf_labels, fh)
+    #end with
+    # the root carries no branch, so no tag
+    for suffix, tree, label_of in (("int.nwk", unrooted, internal_tag), ("clade.nwk", rooted, tag), ("full.nwk", unrooted, tag)):
+        with open (prefix + suffix, "w") as fh:
+            fh.write (newick.write (tree, lambda node: label_of (node) if node.parent is not None else "", lengths))
+        #end with
+    #end for
+    return sum (1 for value in leaf_labels.values () if value == label), sum (1 for node, value in labels.items () if value == label and node.children)
+#end method
+
+# Parity with annotator.bf ------------------------------------------------
+
+def tagged_clades (tree_file):
+    # {leaf set below a branch: branch-set tag} for one annotated tree
+    root = newick.read (tree_file)
+    below = {}
+    result = {}
+    for node in newick.postorder (root):
+        name, _, value = node.name.partition ('{')
+        node.name = name
+        below[node] = frozenset ([name]) if node.is_leaf () else frozenset ().union (*(below[c] for c in node.children))
+        if node.parent is not None:
+            result[below[node]] = value.rstrip ('}')
+        #end if
+    #end for
+    return result
+#end method
+
+def parity (prefix, reference_prefix):
+    # Compare branches (as leaf sets) and their tags with annotator.bf output
+    ok = True
+    for suffix in ("int.nwk", "clade.nwk", "full.nwk"):
+        ours = tagged_clades (prefix + suffix)
+        theirs = tagged_clades (reference_prefix + suffix)
+        topology = set (ours) ^ set (theirs)
+        tags = sum (1 for clade in set (ours) & set (theirs) if ours[clade] != theirs[clade])
+        print("| %s | %d | %d | %d |" % (suffix, len (ours), len (topology), tags))
+        ok = ok and not topology and not tags
+    #end for
+    with open (prefix + "labels.json") as fh, open (reference_prefix + "labels.json") as rfh:
+        same = json.load (fh) == json.load (rfh)
+    #end with
+    print("| labels.json | | | %s |" % ("identical" if same else "differs"))
+    return ok and same
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Reroot on the reference and write .int/.clade/.full.nwk HyPhy branch-set trees')
+    arguments.add_argument('-t', '--tree',       help = 'Combined ML tree ({GENE}.combined.fas.raxml.bestTree)',   required = True, type = str)
+    arguments.add_argument('-r', '--reference',  help = 'Leaf to root on',                                         required = False, type = str, default = "REFERENCE")
+    arguments.add_argument('-q', '--query',      help = 'Query clusters; these leaves get --label',               required = True, type = str)
+    arguments.add_argument('-l', '--label',      help = 'Branch-set label (the analysis label)',                  required = True, type = str)
+    arguments.add_argument('-p', '--prefix',     help = 'Output prefix, e.g. results/<label>/<gene>.',            required = True, type = str)
+    arguments.add_argument('--lengths',          help = 'Keep branch lengths (annotator.bf wrote topology only)', action = 'store_true')
+    arguments.add_argument('--parity',           help = 'Also run hyphy annotator.bf and compare branch sets and tags', action = 'store_true')
+    settings = arguments.parse_args()
+
+    n_leaves, n_internal = annotate (settings.tree, settings.reference, settings.query, settings.label, settings.prefix, settings.lengths)
+    print("# Labeled %d query leaves and %d internal branches %s" % (n_leaves, n_internal, settings.label))
+
+    if settings.parity:
+        tmp = tempfile.mkdtemp ()
+        reference_prefix = os.path.join (tmp, "annotator.")
+        annotator_bf = os.path.join (os.path.dirname (os.path.abspath (__file__)), "annotator.bf")
+        result = os.system ("hyphy %s %s %s %s %s %s" % (annotator_bf, settings.tree, settings.reference, settings.query, settings.label, reference_prefix))
+        if result != 0:
+            print ('Command exection failed code %s' % result)
+            sys.exit(1)
+        #end if
+        print("| tree | branches | topology differences | tag differences |")
+        print("|:---:|:---:|:---:|:---:|")
+        same = parity (settings.prefix, reference_prefix)
+        shutil.rmtree (tmp)
+        sys.exit(0 if same else 1)
+    #end if
+    sys.exit(0)
+#end if
+
+# End of file
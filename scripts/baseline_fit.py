@@ -0,0 +1,143 @@
+# Shared per-gene baseline codon fit: branch lengths for seeding the HyPhy
+# selection analyses, and a report of the fitting time it saved
+
+# Imports -------------------------------------------------------------
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+
+import newick
+
+# Declares
+# Result files of the analyses that start from the baseline tree
+SEEDED = ["SLAC", "FEL", "MEME", "MEME-full", "PRIME", "CFEL",
+          "BUSTED", "BUSTEDS", "BUSTED-MH", "BUSTEDS-MH",
+          "ABSREL", "ABSRELS", "ABSREL-MH", "ABSRELS-MH", "RELAX", "RELAX-MH"]
+
+# HyPhy timers that cover the nucleotide GTR / global MG94xREV fits
+_baseline_timer = re.compile (r"preliminary|nucleotide|gtr|mg94|baseline", re.IGNORECASE)
+
+# Helper functions -----------------------------------------------------
+
+def branch_lengths (fit_file):
+    # {node: length} from a HyPhy result JSON, the MG94 estimate where present
+    with open (fit_file) as fh:
+        attributes = json.load (fh).get ('branch attributes', {}).get ('0', {})
+    #end with
+    lengths = {}
+    for node, values in attributes.items ():
+        numeric = [(k, v) for k, v in values.items () if isinstance (v, (int, float))]
+        mg94 = [v for k, v in numeric if "MG94" in k]
+        gtr = [v for k, v in numeric if "GTR" in k]
+        if mg94 or gtr or numeric:
+            lengths[node] = (mg94 or gtr or [numeric[0][1]])[0]
+        #end if
+    #end for
+    return lengths
+#end method
+
+def fitted_tree (tree_file, fit_file, out_file):
+    # The branch-set tree from annotator.py (names with {LABEL} tags kept)
+    # with the baseline branch lengths filled in
+    root = newick.read (tree_file)
+    lengths = branch_lengths (fit_file)
+    missing = 0
+    for node in newick.postorder (root):
+        if node.parent is None:
+            continue
+        #end if
+        name = node.name.partition ('{')[0]
+        if name in lengths:
+            node.length = lengths[name]
+        else:
+            missing += 1
+        #end if
+    #end for
+    with open (out_file, "w") as fh:
+        fh.write (newick.write (root, lambda node: node.name if node.parent is not None else ""))
+    #end with
+    return len (lengths), missing
+#end method
+
+def baseline_seconds (result_file):
+    # Time a HyPhy result spent on its preliminary (GTR / MG94) fits
+    try:
+        with open (result_file) as fh:
+            timers = json.load (fh).get ('timers', {})
+        #end with
+    except (OSError, ValueError):
+        return None
+    #end try
+    return sum (t.get ('timer', 0.) for name, t in timers.items () if _baseline_timer.search (name) and isinstance (t, dict))
+#end method
+
+def fit_seconds (fit_file):
+    try:
+        with open (fit_file) as fh:
+            timers = json.load (fh).get ('timers', {})
+        #end with
+    except (OSError, ValueError):
+        return 0.
+    #end try
+    overall = [t.get ('timer', 0.) for name, t in timers.items () if re.search ("overall|total", name, re.IGNORECASE) and isinstance (t, dict)]
+    return max (overall) if overall else sum (t.get ('timer', 0.) for t in timers.values () if isinstance (t, dict))
+#end method
+
+def report (results_dir, unseeded_dir):
+    # Per gene: preliminary-fit seconds summed over the seeded analyses in this
+    # run and in a run without the shared fit, and the cost of the shared fits
+    print("| gene | analyses | baseline fits s (unseeded run) | baseline fits s (seeded) | shared fits s | saved s |")
+    print("|:---:|:---:|:---:|:---:|:---:|:---:|")
+    genes = sorted (set (os.path.basename (f).split ('.')[0] for f in glob.glob (os.path.join (results_dir, "*.baseline.json"))))
+    for gene in genes:
+        seeded, unseeded, n = 0., 0., 0
+        for method in SEEDED:
+            now = baseline_seconds (os.path.join (results_dir, "%s.%s.json" % (gene, method)))
+            before = baseline_seconds (os.path.join (unseeded_dir, "%s.%s.json" % (gene, method))) if unseeded_dir else None
+            if now is None or (unseeded_dir and before is None):
+                continue
+            #end if
+            n += 1
+            seeded += now
+            unseeded += before or 0.
+        #end for
+        shared = sum (fit_seconds (f) for f in glob.glob (os.path.join (results_dir, gene + ".*.baseline.json")))
+        saved = "%.0f" % (unseeded - seeded - shared) if unseeded_dir else "n/a"
+        print("| %s | %d | %s | %.0f | %.0f | %s |" % (gene, n, "%.0f" % unseeded if unseeded_dir else "n/a", seeded, shared, saved))
+    #end for
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Seed HyPhy analyses from a shared baseline fit, or report the time it saved')
+    arguments.add_argument('-t', '--tree',       help = 'Branch-set trees from annotator.py ({GENE}.int/clade/full.nwk) with the topology of the fit', required = False, type = str, nargs = '+')
+    arguments.add_argument('-f', '--fit',        help = 'Baseline fit (FitMG94 JSON)',                         required = False, type = str)
+    arguments.add_argument('-o', '--output',     help = 'Tree with baseline branch lengths, one per --tree',   required = False, type = str, nargs = '+')
+    arguments.add_argument('--report',           help = 'Results directory to report savings for',             required = False, type = str)
+    arguments.add_argument('--unseeded',         help = 'Results directory of a run with shareBaselineFit "false"', required = False, type = str)
+    settings = arguments.parse_args()
+
+    if settings.report:
+        report (settings.report, settings.unseeded)
+        sys.exit(0)
+    #end if
+    if not (settings.tree and settings.fit and settings.output):
+        arguments.error ("--tree, --fit and --output are required unless --report is given")
+    #end if
+    if len (settings.tree) != len (settings.output):
+        arguments.error ("one --output per --tree")
+    #end if
+    # int.nwk and full.nwk are one unrooted topology with different branch
+    # sets, so one fit fills in both
+    for tree_file, out_file in zip (settings.tree, settings.output):
+        n_lengths, missing = fitted_tree (tree_file, settings.fit, out_file)
+        print("# %d baseline branch lengths from %s for %s, %d branches without one" % (n_lengths, settings.fit, tree_file, missing))
+    #end for
+    sys.exit(0)
+#end if
+
+# End of file
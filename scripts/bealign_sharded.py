@@ -0,0 +1,128 @@
+# Run bealign on contiguous shards of the input concurrently and merge the BAMs
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from fasta_io import read_fasta, write_fasta, first_record_name
+
+# Declares
+task_runners = {}
+task_runners['bealign'] = "bealign"
+
+# Helper functions -----------------------------------------------------
+
+def split_fasta (in_file, shards, work_dir):
+    # Contiguous chunks, so concatenating the shard outputs keeps input order
+    records = list (read_fasta (in_file))
+    shards = max (1, min (shards, len (records)))
+    per_shard = (len (records) + shards - 1) // shards
+    shard_files = []
+    for s in range (shards):
+        chunk = records[s * per_shard:(s + 1) * per_shard]
+        if not chunk:
+            break
+        #end if
+        shard_file = os.path.join (work_dir, "shard%03d.fa" % s)
+        with open (shard_file, "w") as fh:
+            for seq_id, seq in chunk:
+                write_fasta (fh, seq_id, seq)
+            #end for
+        #end with
+        shard_files.append (shard_file)
+    #end for
+    return shard_files
+#end method
+
+def run_bealign (reference, matrix, keep_reference, in_file, out_file):
+    cmd = [task_runners['bealign'], '-r', reference, '-m', matrix] + (['-K'] if keep_reference else []) + [in_file, out_file]
+    print(" ".join (cmd))
+    subprocess.run (cmd, check = True)
+    return out_file
+#end method
+
+def merge_bams (shard_bams, out_file, reference_name = None):
+    import pysam
+
+    with pysam.AlignmentFile (shard_bams[0], "rb", check_sq = False) as first:
+        header = first.header
+    #end with
+    with pysam.AlignmentFile (out_file, "wb", header = header) as out:
+        for i, shard_bam in enumerate (shard_bams):
+            with pysam.AlignmentFile (shard_bam, "rb", check_sq = False) as bam:
+                for read in bam.fetch (until_eof = True):
+                    # with -K every shard carries the reference, keep only the first copy
+                    if i > 0 and reference_name is not None and read.query_name == reference_name:
+                        continue
+                    #end if
+                    out.write (read)
+                #end for
+            #end with
+        #end for
+    #end with
+#end method
+
+def sharded_bealign (in_file, reference, out_file, threads, matrix = "HIV_BETWEEN_F", keep_reference = False):
+    work_dir = tempfile.mkdtemp (prefix = os.path.basename (out_file) + ".", dir = os.path.dirname (os.path.abspath (out_file)))
+    try:
+        shard_files = split_fasta (in_file, threads, work_dir)
+        if len (shard_files) <= 1:
+            run_bealign (reference, matrix, keep_reference, in_file, out_file)
+            return 1
+        #end if
+        shard_bams = [f + ".bam" for f in shard_files]
+        with ThreadPoolExecutor (max_workers = threads) as pool:
+            list (pool.map (lambda f: run_bealign (reference, matrix, keep_reference, f, f + ".bam"), shard_files))
+        #end with
+        merge_bams (shard_bams, out_file, first_record_name (reference) if keep_reference else None)
+        return len (shard_files)
+    finally:
+        shutil.rmtree (work_dir, ignore_errors = True)
+    #end try
+#end method
+
+def benchmark (in_file, reference, out_file, matrix, keep_reference, max_threads):
+    # Scaling curve from 1 core up to the allocation, doubling each step
+    print("| threads | shards | seconds | speedup |")
+    print("|:---:|:---:|:---:|:---:|")
+    thread_counts = sorted (set ([t for t in (1, 2, 4, 8, 16, 32, 64) if t < max_threads] + [max_threads]))
+    baseline = None
+    for threads in thread_counts:
+        start = time.perf_counter ()
+        shards = sharded_bealign (in_file, reference, out_file, threads, matrix, keep_reference)
+        elapsed = time.perf_counter () - start
+        baseline = baseline or elapsed
+        print("| %d | %d | %.2f | %.2fx |" % (threads, shards, elapsed, baseline / elapsed))
+    #end for
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Codon-align sequences to a reference with one bealign process per shard')
+    arguments.add_argument('-i', '--input',          help = 'Unaligned FASTA',                                      required = True, type = str)
+    arguments.add_argument('-r', '--reference',      help = 'Reference gene FASTA',                                 required = True, type = str)
+    arguments.add_argument('-o', '--output',         help = 'Merged BAM file',                                      required = True, type = str)
+    arguments.add_argument('-m', '--matrix',         help = 'bealign scoring matrix',                               required = False, type = str, default = "HIV_BETWEEN_F")
+    arguments.add_argument('-K', '--keep_reference', help = 'Keep the reference in the output (bealign -K)',        action = 'store_true')
+    arguments.add_argument('-t', '--threads',        help = 'Number of concurrent bealign processes',               required = False, type = int, default = 1)
+    arguments.add_argument('--benchmark',            help = 'Time 1, 2, 4, ... --threads shards and print the scaling curve', action = 'store_true')
+    settings = arguments.parse_args()
+
+    if settings.benchmark:
+        benchmark (settings.input, settings.reference, settings.output, settings.matrix, settings.keep_reference, settings.threads)
+    else:
+        start = time.perf_counter ()
+        shards = sharded_bealign (settings.input, settings.reference, settings.output, settings.threads, settings.matrix, settings.keep_reference)
+        print("# Aligned %d shard(s) on %d thread(s) in %.2fs" % (shards, settings.threads, time.perf_counter () - start))
+    #end if
+    sys.exit(0)
+#end if
+
+# End of file
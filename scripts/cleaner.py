@@ -0,0 +1,61 @@
+# Streaming FASTA cleaner for GISAID EpiFlu downloads
+
+# Imports -------------------------------------------------------------
+import re
+import sys
+import time
+import argparse
+
+from fasta_io import open_input
+
+# Declares
+# Same character substitutions as the original sed passes, applied to every line
+_substitutions = bytes.maketrans (b" |/-", b"____")
+
+# Header rewrite from the original gawk pass.
+# Note that it is applied after '|' was substituted (same order as the
+# shell version), so cleaned ids stay identical to previous runs.
+_epi_isl_header = re.compile (rb">(.+)\|(EPI_ISL_|epi_isl_)([0-9]+)\|(.+)")
+
+# Helper functions -----------------------------------------------------
+
+def clean_header (line):
+    return _epi_isl_header.sub (rb">epi_isl_\3/\1", line)
+#end method
+
+def clean_fasta (in_file, out_file, buffer_size = 1 << 20):
+    bytes_in = 0
+    records = 0
+    start = time.perf_counter ()
+    with open_input (in_file, "rb") as fh, open (out_file, "wb", buffering = buffer_size) as out:
+        for line in fh:
+            bytes_in += len (line)
+            line = line.rstrip (b"\n").translate (_substitutions)
+            if line[:1] == b'>':
+                records += 1
+                line = clean_header (line)
+            #end if
+            out.write (line)
+            out.write (b"\n")
+        #end for
+    #end with
+    return bytes_in, records, time.perf_counter () - start
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Normalize GISAID FASTA headers in a single streaming pass')
+    arguments.add_argument('-i', '--input',  help = 'FASTA file to clean (plain, .gz or .xz)', required = True, type = str)
+    arguments.add_argument('-o', '--output', help = 'Cleaned FASTA file',                      required = True, type = str)
+    settings = arguments.parse_args()
+
+    print("Cleaning: " + settings.input)
+    bytes_in, records, elapsed = clean_fasta (settings.input, settings.output)
+    elapsed = max (elapsed, 1e-9)
+    print("# Cleaned %d records (%.1f MB) in %.2fs" % (records, bytes_in / 1e6, elapsed))
+    print("# Throughput: %.1f MB/s, %.0f records/s" % (bytes_in / 1e6 / elapsed, records / elapsed))
+    sys.exit(0)
+#end if
+
+# End of file
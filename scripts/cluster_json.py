@@ -0,0 +1,163 @@
+# Streaming reader/writer for tn93-cluster JSON (a list of cluster objects)
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import json
+import argparse
+import hashlib
+
+# Declares
+CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder ()
+
+# Helper functions -----------------------------------------------------
+
+def iter_clusters (filename, chunk_size = CHUNK_SIZE):
+    # Yields one cluster dict at a time; memory is bounded by the read buffer
+    # plus the largest single cluster
+    with open (filename, "r") as fh:
+        buffer = ""
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            # skip separators between objects
+            while pos < len (buffer) and buffer[pos] in " \t\r\n,[]":
+                if buffer[pos] == '[':
+                    started = True
+                #end if
+                pos += 1
+            #end while
+            if pos < len (buffer):
+                if not started:
+                    raise ValueError ("%s is not a JSON list of clusters" % filename)
+                #end if
+                try:
+                    cluster, end = _decoder.raw_decode (buffer, pos)
+                    yield cluster
+                    pos = end
+                    continue
+                except ValueError:
+                    if eof:
+                        raise
+                    #end if
+                #end try
+            elif eof:
+                break
+            #end if
+            chunk = fh.read (chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+        #end while
+    #end with
+#end method
+
+class ClusterWriter:
+    # Writes clusters one at a time in the same list layout json.dump produces
+    def __init__ (self, filename):
+        self.fh = open (filename, "w")
+        self.count = 0
+        self.fh.write ("[")
+    #end method
+
+    def write (self, cluster):
+        if self.count:
+            self.fh.write (", ")
+        #end if
+        json.dump (cluster, self.fh)
+        self.count += 1
+    #end method
+
+    def close (self):
+        self.fh.write ("]")
+        self.fh.close ()
+    #end method
+
+    def __enter__ (self):
+        return self
+    #end method
+
+    def __exit__ (self, *args):
+        self.close ()
+    #end method
+#end class
+
+class CompactIdSet:
+    # Membership on 8-byte digests instead of the id strings themselves
+    def __init__ (self):
+        self.digests = set ()
+    #end method
+
+    def _key (self, seq_id):
+        return hashlib.blake2b (seq_id.encode (), digest_size = 8).digest ()
+    #end method
+
+    def add (self, seq_id):
+        self.digests.add (self._key (seq_id))
+    #end method
+
+    def __contains__ (self, seq_id):
+        return self._key (seq_id) in self.digests
+    #end method
+
+    def __len__ (self):
+        return len (self.digests)
+    #end method
+#end class
+
+def centroid_record (cluster):
+    # (">id", sequence) from the "centroid" field of a cluster
+    header, _, seq = cluster['centroid'].partition ('\n')
+    return header, seq.replace ('\n', '').replace (' ', '')
+#end method
+
+def benchmark (n_clusters, members_per_cluster, seq_length):
+    # Peak Python heap of json.load vs iter_clusters on a synthetic cluster file
+    import random
+    import tempfile
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory () as tmp:
+        filename = os.path.join (tmp, "clusters.json")
+        seq = "".join (random.choice ("ACGT") for _ in range (seq_length))
+        with ClusterWriter (filename) as out:
+            for c in range (n_clusters):
+                out.write ({'centroid': ">c%d\n%s" % (c, seq), 'members': ["epi_isl_%d/A/sample/%d" % (c * members_per_cluster + m, m) for m in range (members_per_cluster)]})
+            #end for
+        #end with
+        size = os.path.getsize (filename)
+
+        tracemalloc.start ()
+        with open (filename) as fh:
+            n = len (json.load (fh))
+        #end with
+        full_peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+
+        tracemalloc.start ()
+        n = sum (1 for c in iter_clusters (filename))
+        streaming_peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+    #end with
+    print("| file MB | clusters | json.load peak MB | iter_clusters peak MB |")
+    print("|:---:|:---:|:---:|:---:|")
+    print("| %.1f | %d | %.1f | %.1f |" % (size / 1e6, n, full_peak / 1e6, streaming_peak / 1e6))
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Peak memory of streaming vs whole-file cluster JSON parsing')
+    arguments.add_argument('--clusters', help = 'Number of synthetic clusters', required = False, type = int, default = 20000)
+    arguments.add_argument('--members',  help = 'Members per cluster',          required = False, type = int, default = 50)
+    arguments.add_argument('--length',   help = 'Centroid sequence length',     required = False, type = int, default = 1700)
+    settings = arguments.parse_args()
+
+    benchmark (settings.clusters, settings.members, settings.length)
+    sys.exit(0)
+#end if
+
+# End of file
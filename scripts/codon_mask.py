@@ -0,0 +1,148 @@
+# Vectorized stop codon and ambiguous codon masking (hyphy cln + strike-ambigs.bf)
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from fasta_io import read_fasta, write_fasta
+
+# Declares
+# Nucleotide codes: A, C, G, T = 0..3, anything else is ambiguous, '-' is a gap
+NUC_AMBIG = 4
+NUC_GAP = 5
+_nuc_lut = np.full (256, NUC_AMBIG, dtype = np.uint8)
+for i, c in enumerate ("ACGT"):
+    _nuc_lut[ord (c)] = i
+    _nuc_lut[ord (c.lower ())] = i
+#end for
+_nuc_lut[ord ('-')] = NUC_GAP
+
+# Codon index: 0..63 for resolved codons, then one code each for incompletely
+# resolved codons and for fully gapped ones
+CODON_AMBIG = 64
+CODON_GAP = 65
+
+# Universal genetic code
+STOP_CODONS = ("TAA", "TAG", "TGA")
+_stop_lut = np.zeros (66, dtype = bool)
+for c in STOP_CODONS:
+    _stop_lut[16 * "ACGT".index (c[0]) + 4 * "ACGT".index (c[1]) + "ACGT".index (c[2])] = True
+#end for
+
+task_runners = {}
+task_runners['hyphy'] = "hyphy"
+
+# Helper functions -----------------------------------------------------
+
+def to_array (rows):
+    # (n_seqs x n_sites) uint8 array of upper-case characters
+    lengths = set (len (r) for r in rows)
+    if len (lengths) > 1:
+        raise ValueError ("Alignment rows have different lengths: %s" % sorted (lengths))
+    #end if
+    return np.frombuffer ("".join (rows).upper ().encode (), dtype = np.uint8).reshape (len (rows), -1).copy ()
+#end method
+
+def codon_index (chars):
+    # (n_seqs x n_codons) codon-index array
+    n, sites = chars.shape
+    nuc = _nuc_lut[chars[:, :sites - sites % 3]].reshape (n, -1, 3)
+    index = (16 * nuc[:, :, 0].astype (np.uint16) + 4 * nuc[:, :, 1] + nuc[:, :, 2]).astype (np.uint8)
+    resolved = (nuc < 4).all (axis = 2)
+    index[~resolved] = CODON_AMBIG
+    index[(nuc == NUC_GAP).all (axis = 2)] = CODON_GAP
+    return index
+#end method
+
+def mask_codons (chars, index, mask):
+    n = chars.shape[0]
+    codons = chars[:, :index.shape[1] * 3].reshape (n, -1, 3)
+    codons[mask] = ord ('-')
+#end method
+
+def mask_block (rows, stops = True, ambigs = True):
+    # Returns the masked character array, the array after stop removal only, and
+    # the number of struck ambiguous codons per row
+    chars = to_array (rows)
+    index = codon_index (chars)
+    if stops:
+        stop_mask = _stop_lut[index]
+        mask_codons (chars, index, stop_mask)
+        index[stop_mask] = CODON_GAP
+    #end if
+    no_stops = chars.copy ()
+    struck = np.zeros (chars.shape[0], dtype = np.int64)
+    if ambigs:
+        ambig_mask = index == CODON_AMBIG
+        struck = ambig_mask.sum (axis = 1)
+        mask_codons (chars, index, ambig_mask)
+    #end if
+    return chars, no_stops, struck
+#end method
+
+def rows_from_array (chars):
+    return [r.tobytes ().decode () for r in chars]
+#end method
+
+def compare_with_hyphy (in_file, masked_file):
+    # Run the HyPhy scripts this module replaces and compare the outputs
+    script_dir = os.path.dirname (os.path.abspath (__file__))
+    with tempfile.TemporaryDirectory () as tmp:
+        ns = os.path.join (tmp, "msa.NS")
+        sa = os.path.join (tmp, "msa.SA")
+        subprocess.run ([task_runners['hyphy'], "cln", "Universal", in_file, "No/No", ns], check = True, stdout = subprocess.DEVNULL)
+        subprocess.run ([task_runners['hyphy'], os.path.join (script_dir, "strike-ambigs.bf"), "--alignment", ns, "--output", sa], check = True, stdout = subprocess.DEVNULL)
+        expected = dict ((k, v.upper ()) for k, v in read_fasta (sa))
+    #end with
+    observed = dict (read_fasta (masked_file))
+    mismatches = [k for k in expected if observed.get (k) != expected[k]]
+    missing = set (expected) ^ set (observed)
+    print("# HyPhy comparison: %d sequences, %d mismatched, %d present in only one output" % (len (expected), len (mismatches), len (missing)))
+    for k in mismatches[:10]:
+        print("#   mismatch: %s" % k)
+    #end for
+    return not mismatches and not missing
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Replace stop codons and incompletely resolved codons with --- (Universal code)')
+    arguments.add_argument('-i', '--input',        help = 'In-frame codon alignment (FASTA)',                       required = True, type = str)
+    arguments.add_argument('-o', '--output',       help = 'Masked alignment',                                        required = True, type = str)
+    arguments.add_argument('--compare-hyphy',      help = 'Also run hyphy cln + strike-ambigs.bf and report differences', action = 'store_true')
+    settings = arguments.parse_args()
+
+    names, rows = [], []
+    for seq_name, row in read_fasta (settings.input):
+        names.append (seq_name)
+        rows.append (row)
+    #end for
+
+    changed = 0
+    with open (settings.output, "w") as fh:
+        if rows:
+            chars, no_stops, struck = mask_block (rows)
+            for seq_name, row, s in zip (names, rows_from_array (chars), struck):
+                if s > 0:
+                    changed += 1
+                    print ("Striking %d codons that are incompletely resolved from %s" % (s, seq_name))
+                #end if
+                write_fasta (fh, seq_name, row)
+            #end for
+        #end if
+    #end with
+    print("# Wrote %d sequences, %d with struck codons" % (len (rows), changed))
+
+    if settings.compare_hyphy:
+        sys.exit(0 if compare_with_hyphy (settings.input, settings.output) else 1)
+    #end if
+    sys.exit(0)
+#end if
+
+# End of file
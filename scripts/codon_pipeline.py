@@ -0,0 +1,113 @@
+# Fused bam2msa + stop codon removal + ambiguous codon striking
+
+# Imports -------------------------------------------------------------
+import sys
+import argparse
+
+from fasta_io import write_fasta
+from codon_mask import mask_block, rows_from_array
+
+# Declares
+# Rows are masked in blocks of this many sequences
+BLOCK_SIZE = 4096
+
+# pysam CIGAR operations
+_consumes_both = (0, 7, 8)  # M, =, X
+_consumes_ref = (2, 3)      # D, N
+
+# Helper functions -----------------------------------------------------
+
+def bam_to_msa (bam_file):
+    # Same layout as bam2msa: every read projected onto reference coordinates,
+    # insertions relative to the reference dropped
+    import pysam
+
+    with pysam.AlignmentFile (bam_file, "rb", check_sq = False) as bam:
+        for read in bam.fetch (until_eof = True):
+            if read.is_unmapped or read.query_sequence is None:
+                continue
+            #end if
+            ref_length = bam.lengths[read.reference_id]
+            query = read.query_sequence
+            aligned = ['-' * read.reference_start]
+            q = 0
+            for op, length in read.cigartuples:
+                if op in _consumes_both:
+                    aligned.append (query[q:q + length])
+                    q += length
+                elif op in _consumes_ref:
+                    aligned.append ('-' * length)
+                elif op in (1, 4):  # I, S
+                    q += length
+                #end if
+            #end for
+            row = "".join (aligned)
+            yield read.query_name, row + '-' * (ref_length - len (row))
+        #end for
+    #end with
+#end method
+
+def blocks (records, size = BLOCK_SIZE):
+    block = []
+    for record in records:
+        block.append (record)
+        if len (block) == size:
+            yield block
+            block = []
+        #end if
+    #end for
+    if block:
+        yield block
+    #end if
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='BAM to in-frame, stop-stripped, ambiguity-struck codon alignment in one pass')
+    arguments.add_argument('-b', '--bam',    help = 'BAM file written by bealign',                                   required = True, type = str)
+    arguments.add_argument('-o', '--output', help = 'Final alignment (what strike-ambigs.bf used to write)',         required = True, type = str)
+    arguments.add_argument('--debug',        help = 'Also write the OG (bam2msa) and NS (cln) intermediates to this prefix', required = False, type = str)
+    settings = arguments.parse_args()
+
+    og = ns = None
+    if settings.debug:
+        og = open (settings.debug + ".msa.OG", "w")
+        ns = open (settings.debug + ".msa.NS", "w")
+    #end if
+
+    records = changed = 0
+    with open (settings.output, "w") as fh:
+        for block in blocks (bam_to_msa (settings.bam)):
+            names = [seq_name for seq_name, row in block]
+            rows = [row for seq_name, row in block]
+            records += len (block)
+            chars, no_stops, struck = mask_block (rows)
+            if og:
+                for seq_name, row in zip (names, rows):
+                    write_fasta (og, seq_name, row.upper ())
+                #end for
+                for seq_name, row in zip (names, rows_from_array (no_stops)):
+                    write_fasta (ns, seq_name, row)
+                #end for
+            #end if
+            for seq_name, row, s in zip (names, rows_from_array (chars), struck):
+                if s > 0:
+                    changed += 1
+                    print ("Striking %d codons that are incompletely resolved from %s" % (s, seq_name))
+                #end if
+                write_fasta (fh, seq_name, row)
+            #end for
+        #end for
+    #end with
+
+    if og:
+        og.close ()
+        ns.close ()
+    #end if
+
+    print("# Wrote %d sequences, %d with struck codons" % (records, changed))
+    sys.exit(0)
+#end if
+
+# End of file
@@ -5,6 +5,8 @@ import argparse
 import json
 import shutil
 import csv
+import time
+import random
 import Bio
 from Bio import SeqIO
 
@@ -16,6 +18,11 @@ arguments.add_argument('-o', '--output_fasta',           help = 'Output json fil
 arguments.add_argument('-m', '--msa',              help = 'Distance threshold for clustering query sequences',    required = True, type = str)
 arguments.add_argument('--threshold',              help = 'Distance threshold for clustering query sequences',    required = True, type = float)
 arguments.add_argument('-r', '--reference_seq',    help = 'Wuhan reference sequence',               required = False, type = str)
+arguments.add_argument('--engine',                 help = 'tn93 subprocess or the in-process tn93_engine', required = False, type = str, default = "tn93", choices = ["tn93", "native"])
+arguments.add_argument('-t', '--threads',          help = 'Worker threads for the native engine',     required = False, type = int, default = 1)
+arguments.add_argument('--prefilter',              help = 'Native engine: exact TN93 on all pairs, or only on MinHash sketch candidates', required = False, type = str, default = "none", choices = ["none", "sketch"])
+arguments.add_argument('--csv',                    help = 'Native engine: also write every query/background pair within threshold here (diagnostic)', required = False, type = str)
+arguments.add_argument('--distance_cache',         help = 'Native engine: per-gene distance cache directory shared with tn93_cluster.py', required = False, type = str)
 settings = arguments.parse_args()
 
 # Output is {GENE}.combined.fas
@@ -61,20 +68,78 @@ def run_command (exec, arguments, filename, tag):
     return os.path.getmtime(filename)
 #end method
 
-# Main -------
-input_stamp = run_command (task_runners['tn93'], ['-o', tn93_pairwise_calcs, '-s', ref_msa, '-t', "%g" % (threshold*2.0), query_compressed], tn93_pairwise_calcs, "filtering reference sequuences that are closer than %g to any query cluster" % (threshold*2.0))
+def close_background_native (query_file, background_file, threshold, threads, prefilter = "none"):
+    # Background ids within threshold of any query cluster, computed in memory
+    import tn93_engine
 
-with open(tn93_pairwise_calcs) as fh:
-    reader = csv.reader (fh, delimiter = ',')
-    next (reader)
-    seqs_to_filter = set ()
-    for l in reader:
-        seqs_to_filter.add (l[1])
-    #end for
-    if _ref_seq_name in seqs_to_filter:
-        seqs_to_filter.remove (_ref_seq_name)
+    print("# tn93_engine neighbours of %s in %s within %g" % (query_file, background_file, threshold))
+    query_ids, query_seqs = tn93_engine.read_alignment (query_file)
+    background_ids, background_seqs = tn93_engine.read_alignment (background_file)
+    if prefilter == "sketch":
+        import sketch_index
+        close, candidates = sketch_index.close_background (query_seqs, background_seqs, threshold, threads = threads)
+        print("# %d pairs compared exactly of %d" % (candidates, len (query_seqs) * len (background_seqs)))
+        return set (background_ids[j] for j in close)
     #end if
-#end with
+    if settings.distance_cache:
+        from distance_cache import DistanceCache
+        cache = DistanceCache (settings.distance_cache)
+        if not settings.csv:
+            # pairs the cache holds, any_neighbor with its early exit for the rest;
+            # the query by background block is stored for the next run
+            found = cache.close_rows (query_seqs, background_seqs, threshold, threads = threads, stage = "combine")
+            return set (background_ids[j] for j in found.nonzero ()[0])
+        #end if
+        # every qualifying pair, answered from the cache where earlier runs computed it
+        pairs = cache.neighbors (query_seqs, background_seqs, threshold, threads = threads, stage = "combine")
+        with open (settings.csv, "w") as fh:
+            print ("ID1,ID2,Distance", file = fh)
+            for i, j, d in pairs:
+                print ("%s,%s,%g" % (query_ids[i], background_ids[j], d), file = fh)
+            #end for
+        #end with
+        return set (background_ids[j] for i, j, d in pairs)
+    #end if
+    query_codes = tn93_engine.encode (query_seqs)
+    background_codes = tn93_engine.encode (background_seqs)
+    if settings.csv:
+        # every qualifying pair, as tn93 -o would write them
+        with open (settings.csv, "w") as fh:
+            print ("ID1,ID2,Distance", file = fh)
+            for i, j, d in tn93_engine.neighbors (query_codes, background_codes, threshold, threads):
+                print ("%s,%s,%g" % (query_ids[i], background_ids[j], d), file = fh)
+            #end for
+        #end with
+    #end if
+    # only membership matters here, so each background sequence stops at its first hit
+    found = tn93_engine.any_neighbor (query_codes, background_codes, threshold, threads)
+    return set (background_ids[j] for j in found.nonzero ()[0])
+#end method
+
+def close_background_tn93 (query_file, background_file, threshold):
+    input_stamp = run_command (task_runners['tn93'], ['-o', tn93_pairwise_calcs, '-s', background_file, '-t', "%g" % threshold, query_file], tn93_pairwise_calcs, "filtering reference sequuences that are closer than %g to any query cluster" % threshold)
+    close = set ()
+    with open(tn93_pairwise_calcs) as fh:
+        reader = csv.reader (fh, delimiter = ',')
+        next (reader)
+        for l in reader:
+            close.add (l[1])
+        #end for
+    #end with
+    return close
+#end method
+
+# Main -------
+start = time.perf_counter ()
+if settings.engine == "native":
+    seqs_to_filter = close_background_native (query_compressed, ref_msa, threshold*2.0, settings.threads, settings.prefilter)
+else:
+    seqs_to_filter = close_background_tn93 (query_compressed, ref_msa, threshold*2.0)
+#end if
+if _ref_seq_name in seqs_to_filter:
+    seqs_to_filter.remove (_ref_seq_name)
+#end if
+print("# %d background sequences excluded in %.2fs" % (len (seqs_to_filter), time.perf_counter () - start))
 
 # Copy query_compressed to output .combined.fas
 shutil.copy (query_compressed, combined_msa)
@@ -105,6 +170,8 @@ with open (combined_msa, "a+") as fh:
 
 #os.remove (pairwise)
 #input_stamp = os.path.getmtime(combined_msa)
+written = [f for f in (combined_msa, tn93_pairwise_calcs if settings.engine != "native" else settings.csv) if f and os.path.exists (f)]
+print("# Wrote %d bytes (%s)" % (sum (os.path.getsize (f) for f in written), ", ".join (written)))
   
 if ADD_REF == False:
     # Add the reference
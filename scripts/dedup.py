@@ -0,0 +1,81 @@
+# Content-addressed deduplication of a cleaned FASTA
+
+# Imports -------------------------------------------------------------
+import sys
+import csv
+import hashlib
+import argparse
+
+from fasta_io import read_fasta, write_fasta
+
+# Declares
+# Characters that do not change the sequence content (cleaner.sh turns gaps and
+# spaces into '_')
+_ignored = str.maketrans ("", "", "-_ \t\r\n")
+
+# Helper functions -----------------------------------------------------
+
+def normalize_sequence (seq):
+    return seq.translate (_ignored).upper ()
+#end method
+
+def sequence_hash (seq):
+    return hashlib.blake2b (normalize_sequence (seq).encode (), digest_size = 12).hexdigest ()
+#end method
+
+def load_multiplicity (sidecar):
+    # representative id -> number of input records sharing its sequence
+    counts = {}
+    representatives = {}
+    with open (sidecar) as fh:
+        reader = csv.DictReader (fh, delimiter = '\t')
+        for row in reader:
+            if row['hash'] not in representatives:
+                representatives[row['hash']] = row['id']
+                counts[row['id']] = int (row['count'])
+            #end if
+        #end for
+    #end with
+    return counts
+#end method
+
+def deduplicate (in_file, out_file, sidecar):
+    representatives = {}
+    rows = []
+    with open (out_file, "w") as fh:
+        for seq_id, seq in read_fasta (in_file):
+            h = sequence_hash (seq)
+            rows.append ((seq_id, h))
+            if h in representatives:
+                representatives[h] += 1
+            else:
+                representatives[h] = 1
+                write_fasta (fh, seq_id, seq)
+            #end if
+        #end for
+    #end with
+    with open (sidecar, "w") as fh:
+        writer = csv.writer (fh, delimiter = '\t', lineterminator = '\n')
+        writer.writerow (['id', 'hash', 'count'])
+        for seq_id, h in rows:
+            writer.writerow ([seq_id, h, representatives[h]])
+        #end for
+    #end with
+    return len (rows), len (representatives)
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Keep one representative per identical sequence and record multiplicities')
+    arguments.add_argument('-i', '--input',   help = 'Cleaned FASTA file',                    required = True, type = str)
+    arguments.add_argument('-o', '--output',  help = 'FASTA file with unique sequences',      required = True, type = str)
+    arguments.add_argument('-s', '--sidecar', help = 'Output id/hash/count table (.tsv)',     required = True, type = str)
+    settings = arguments.parse_args()
+
+    total, unique = deduplicate (settings.input, settings.output, settings.sidecar)
+    print("# Records: %d, unique sequences: %d" % (total, unique))
+    sys.exit(0)
+#end if
+
+# End of file
@@ -0,0 +1,113 @@
+# Split a cleaned multi-segment FASTA into per-segment shards
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import time
+import argparse
+
+from fasta_io import read_fasta, write_fasta
+
+# Declares
+# Shorter k-mers tolerate the divergence between GISAID isolates and the
+# subtype reference, sampling every few positions keeps this pass cheap.
+KMER_SIZE = 12
+KMER_STEP = 3
+
+# A segment call needs this many sampled k-mer hits, and must clearly beat the
+# runner-up, otherwise the record is treated as unassigned
+MIN_HITS = 5
+MIN_MARGIN = 4
+
+# Helper functions -----------------------------------------------------
+
+def load_segment_index (reference_dir, gene_segments, file_ending = ".fasta", k = KMER_SIZE):
+    # k-mer -> set of segments whose reference genes contain it
+    index = {}
+    for gene, segment in gene_segments.items():
+        ref_file = os.path.join(reference_dir, gene + file_ending)
+        for seq_id, seq in read_fasta (ref_file):
+            seq = seq.upper().replace ("U", "T")
+            for i in range (len (seq) - k + 1):
+                index.setdefault (seq[i:i+k], set()).add (segment)
+            #end for
+        #end for
+    #end for
+    return index
+#end method
+
+def classify (seq, index, k = KMER_SIZE, step = KMER_STEP):
+    hits = {}
+    seq = seq.upper().replace ("U", "T")
+    for i in range (0, len (seq) - k + 1, step):
+        for segment in index.get (seq[i:i+k], ()):
+            hits[segment] = hits.get (segment, 0) + 1
+        #end for
+    #end for
+    ranked = sorted (hits.items(), key = lambda h: h[1], reverse = True)
+    if not ranked or ranked[0][1] < MIN_HITS:
+        return None
+    #end if
+    if len (ranked) > 1 and ranked[0][1] < MIN_MARGIN * ranked[1][1]:
+        return None
+    #end if
+    return ranked[0][0]
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Assign each record of a cleaned FASTA to its genome segment')
+    arguments.add_argument('-i', '--input',         help = 'Cleaned multi-segment FASTA',                         required = True, type = str)
+    arguments.add_argument('-r', '--reference_dir', help = 'Directory with the per-gene reference sequences',      required = True, type = str)
+    arguments.add_argument('-e', '--file_ending',   help = 'File ending of the reference gene files',             required = False, type = str, default = ".fasta")
+    arguments.add_argument('-g', '--gene_segment',  help = 'GENE=SEGMENT assignment (repeat for every gene)',     required = True, type = str, nargs = '+')
+    arguments.add_argument('-s', '--shard',         help = 'SEGMENT=FILE output shard (repeat for every segment)', required = True, type = str, nargs = '+')
+    settings = arguments.parse_args()
+
+    gene_segments = dict (g.split ("=", 1) for g in settings.gene_segment)
+    shard_files = dict (s.split ("=", 1) for s in settings.shard)
+
+    missing = set (gene_segments.values()) - set (shard_files)
+    if missing:
+        print ("No output shard given for segment(s): %s" % ", ".join (sorted (missing)))
+        sys.exit(1)
+    #end if
+
+    print("# Loading segment references from:", settings.reference_dir)
+    index = load_segment_index (settings.reference_dir, gene_segments, settings.file_ending)
+
+    start = time.perf_counter ()
+    counts = {segment: 0 for segment in shard_files}
+    unassigned = 0
+    shards = {segment: open (path, "w") for segment, path in shard_files.items()}
+    try:
+        for seq_id, seq in read_fasta (settings.input):
+            segment = classify (seq, index)
+            if segment is None:
+                # No confident segment call, let every aligner have a go
+                # at it, same as before this stage existed
+                unassigned += 1
+                for fh in shards.values():
+                    write_fasta (fh, seq_id, seq)
+                #end for
+            else:
+                counts[segment] += 1
+                write_fasta (shards[segment], seq_id, seq)
+            #end if
+        #end for
+    finally:
+        for fh in shards.values():
+            fh.close ()
+        #end for
+    #end try
+
+    for segment in sorted (counts):
+        print("# %s: %d records" % (segment, counts[segment]))
+    #end for
+    print("# Unassigned (written to every shard): %d" % unassigned)
+    print("# Demultiplexed in %.2fs" % (time.perf_counter () - start))
+    sys.exit(0)
+#end if
+
+# End of file
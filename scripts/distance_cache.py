@@ -0,0 +1,407 @@
+# Content-addressed per-gene cache of TN93 distances under a cutoff
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+
+import numpy as np
+
+import tn93_engine
+
+# Declares
+# pairs.bin holds (hash_a, hash_b, distance) records with hash_a < hash_b for
+# every compared pair within the cutoff of its block. Absent pairs are only
+# known to be further apart when both sequences were in one compared block, so
+# manifest.json lists the blocks: hash sets on either side, their sizes and the
+# cutoff used. Distances are kept in double precision, as tn93_engine computes
+# them, so a cached pair compares against a threshold exactly like a fresh one.
+PAIR_DTYPE = np.dtype ([('a', '<u8'), ('b', '<u8'), ('d', '<f8')])
+CACHE_VERSION = 2
+
+# Blocks kept per gene; older ones are dropped and pairs.bin is rewritten with
+# only the pairs the remaining blocks need
+MAX_BLOCKS = 16
+
+# Helper functions -----------------------------------------------------
+
+def row_hashes (seqs):
+    # Aligned rows are the content: the same row always has the same distances
+    return np.array ([int.from_bytes (hashlib.blake2b (s.upper ().encode (), digest_size = 8).digest (), "little") for s in seqs], dtype = np.uint64)
+#end method
+
+def _lookup (sorted_hashes, query):
+    # Position of each query hash in a sorted hash array, -1 when absent
+    if len (sorted_hashes) == 0:
+        return np.full (len (query), -1, dtype = np.int64)
+    #end if
+    pos = np.minimum (np.searchsorted (sorted_hashes, query), len (sorted_hashes) - 1)
+    return np.where (sorted_hashes[pos] == query, pos, -1)
+#end method
+
+class DistanceCache:
+    def __init__ (self, directory, mode = "resolve", min_overlap = tn93_engine.MIN_OVERLAP):
+        self.directory = directory
+        self.mode = mode
+        self.min_overlap = min_overlap
+        os.makedirs (os.path.join (directory, "blocks"), exist_ok = True)
+        self.pairs_file = os.path.join (directory, "pairs.bin")
+        self.manifest_file = os.path.join (directory, "manifest.json")
+        self.stats_file = os.path.join (directory, "stats.jsonl")
+        self.lock_file = os.path.join (directory, ".lock")
+    #end method
+
+    def _manifest (self):
+        params = {'version': CACHE_VERSION, 'mode': self.mode, 'min_overlap': self.min_overlap}
+        if os.path.exists (self.manifest_file):
+            with open (self.manifest_file) as fh:
+                manifest = json.load (fh)
+            #end with
+            if manifest.get ('params') == params:
+                return manifest
+            #end if
+            print("# Distance cache %s was built with %s, not reusing it" % (self.directory, manifest.get ('params')))
+        #end if
+        return {'params': params, 'committed': 0, 'blocks': []}
+    #end method
+
+    def _pairs (self, committed):
+        if committed == 0:
+            return np.zeros (0, dtype = PAIR_DTYPE)
+        #end if
+        return np.memmap (self.pairs_file, dtype = PAIR_DTYPE, mode = 'r', shape = (committed,))
+    #end method
+
+    def _best_block (self, manifest, hx, hy, symmetric, threshold):
+        # The block covering the most requested pairs at a cutoff >= threshold,
+        # as (mask over x, mask over y)
+        best = (0, np.zeros (len (hx), dtype = bool), np.zeros (len (hy), dtype = bool))
+        for block in manifest['blocks']:
+            if block['cutoff'] < threshold or block['size'][0] * block['size'][1] <= best[0]:
+                continue
+            #end if
+            left = np.load (os.path.join (self.directory, block['left']))
+            right = left if block['symmetric'] else np.load (os.path.join (self.directory, block['right']))
+            if symmetric and not block['symmetric']:
+                continue
+            #end if
+            orientations = [(left, right)] + ([] if block['symmetric'] else [(right, left)])
+            for l, r in orientations:
+                in_x = np.isin (hx, l)
+                in_y = in_x if symmetric else np.isin (hy, r)
+                covered = int (in_x.sum ()) * int (in_y.sum ())
+                if covered > best[0]:
+                    best = (covered, in_x, in_y)
+                #end if
+            #end for
+        #end for
+        return best[1], best[2]
+    #end method
+
+    def _read (self, ux, uy, symmetric, threshold):
+        # Under a shared lock: the best block as (mask over x, mask over y), and
+        # the stored pairs within threshold inside it as index arrays into ux
+        # and uy (i < j when symmetric)
+        with open (self.lock_file, "w") as lock:
+            fcntl.flock (lock, fcntl.LOCK_SH)
+            manifest = self._manifest ()
+            in_x, in_y = self._best_block (manifest, ux, uy, symmetric, threshold)
+            stored = self._pairs (manifest['committed'])
+            inside = ux[in_x] if symmetric else np.concatenate ((ux[in_x], uy[in_y]))
+            stored = np.array (stored[(stored['d'] <= threshold) & np.isin (stored['a'], inside) & np.isin (stored['b'], inside)])
+            fcntl.flock (lock, fcntl.LOCK_UN)
+        #end with
+        xi, yi, dd = [], [], []
+        for a, b in (('a', 'b'), ('b', 'a')):
+            i = _lookup (ux, stored[a])
+            j = _lookup (uy, stored[b])
+            ok = (i >= 0) & (j >= 0)
+            ok[ok] &= in_x[i[ok]] & in_y[j[ok]]
+            if symmetric:
+                ok &= i < j
+            #end if
+            xi.append (i[ok])
+            yi.append (j[ok])
+            dd.append (stored['d'][ok])
+        #end for
+        return in_x, in_y, np.concatenate (xi), np.concatenate (yi), np.concatenate (dd)
+    #end method
+
+    def _commit (self, ux, uy, symmetric, threshold, stage, ha, hb, d, add_block, stats):
+        # Under an exclusive lock, against the manifest as it is now: append the
+        # new pairs (hashes HA, HB), then the block they complete, then the stats
+        with open (self.lock_file, "w") as lock:
+            fcntl.flock (lock, fcntl.LOCK_EX)
+            manifest = self._manifest ()
+            if len (d):
+                new = np.zeros (len (d), dtype = PAIR_DTYPE)
+                new['a'], new['b'], new['d'] = np.minimum (ha, hb), np.maximum (ha, hb), d
+                with open (self.pairs_file, "r+b" if os.path.exists (self.pairs_file) else "wb") as fh:
+                    fh.seek (manifest['committed'] * PAIR_DTYPE.itemsize)
+                    new.tofile (fh)
+                    fh.truncate ()
+                #end with
+                manifest['committed'] += len (new)
+            #end if
+            if add_block:
+                block_id = manifest.get ('next_block', len (manifest['blocks']))
+                manifest['next_block'] = block_id + 1
+                block = {'cutoff': threshold, 'symmetric': bool (symmetric), 'stage': stage, 'size': [len (ux), len (uy)],
+                         'left': os.path.join ("blocks", "%06d.left.npy" % block_id), 'right': None}
+                np.save (os.path.join (self.directory, block['left']), ux)
+                if not symmetric:
+                    block['right'] = os.path.join ("blocks", "%06d.right.npy" % block_id)
+                    np.save (os.path.join (self.directory, block['right']), uy)
+                #end if
+                manifest['blocks'].append (block)
+                self._compact (manifest)
+            #end if
+            if len (d) or add_block:
+                self._write_manifest (manifest)
+            #end if
+            with open (self.stats_file, "a") as fh:
+                print (json.dumps (stats), file = fh)
+            #end with
+            fcntl.flock (lock, fcntl.LOCK_UN)
+        #end with
+    #end method
+
+    def neighbors (self, seqs_x, seqs_y, threshold, symmetric = False, threads = 1, stage = "tn93"):
+        # All (i, j, d <= threshold) between seqs_x and seqs_y (i < j within
+        # seqs_x when symmetric), reusing every pair a covering block already
+        # answers and computing only the rest. The cache is only locked to read
+        # and to commit, not while distances are computed.
+        hx = row_hashes (seqs_x)
+        hy = hx if symmetric else row_hashes (seqs_y)
+        # work on unique rows, expand to duplicates at the end
+        ux, x_first, x_inverse = np.unique (hx, return_index = True, return_inverse = True)
+        uy, y_first, y_inverse = (ux, x_first, x_inverse) if symmetric else np.unique (hy, return_index = True, return_inverse = True)
+        codes_x = tn93_engine.encode ([seqs_x[i] for i in x_first])
+        codes_y = codes_x if symmetric else tn93_engine.encode ([seqs_y[i] for i in y_first])
+
+        # pairs the best block already answers
+        in_x, in_y, i, j, d = self._read (ux, uy, symmetric, threshold)
+        xi, yi, dd = [i], [j], [d]
+        if not symmetric:
+            # a row present on both sides is never stored as a pair
+            i = _lookup (ux, uy)
+            j = np.nonzero ((i >= 0) & in_y)[0]
+            i = i[j]
+            j, i = j[in_x[i]], i[in_x[i]]
+            if len (i):
+                d = tn93_engine.paired_distances (codes_x[i], codes_x[i], self.mode, self.min_overlap)
+                xi.append (i[d <= threshold])
+                yi.append (j[d <= threshold])
+                dd.append (d[d <= threshold])
+            #end if
+        #end if
+        reused = sum (len (x) for x in xi)
+
+        # everything else: rows of x outside the block against all of y, and
+        # rows inside it against the part of y outside it
+        ci, cj, cd = [], [], []
+        out_x = np.nonzero (~in_x)[0]
+        if len (out_x):
+            for ii, jj, d in tn93_engine.neighbor_blocks (codes_x[out_x], codes_y, threshold, threads, self.mode, self.min_overlap):
+                ii = out_x[ii]
+                if symmetric:
+                    keep = (ii != jj) & (in_x[jj] | (jj > ii))
+                    ii, jj, d = np.minimum (ii, jj)[keep], np.maximum (ii, jj)[keep], d[keep]
+                #end if
+                ci.append (ii)
+                cj.append (jj)
+                cd.append (d)
+            #end for
+        #end if
+        if not symmetric:
+            in_rows, out_y = np.nonzero (in_x)[0], np.nonzero (~in_y)[0]
+            if len (in_rows) and len (out_y):
+                for ii, jj, d in tn93_engine.neighbor_blocks (codes_x[in_rows], codes_y[out_y], threshold, threads, self.mode, self.min_overlap):
+                    ci.append (in_rows[ii])
+                    cj.append (out_y[jj])
+                    cd.append (d)
+                #end for
+            #end if
+        #end if
+        ci = np.concatenate (ci + [np.zeros (0, dtype = np.int64)])
+        cj = np.concatenate (cj + [np.zeros (0, dtype = np.int64)])
+        cd = np.concatenate (cd + [np.zeros (0)])
+
+        requested = len (ux) * (len (ux) - 1) // 2 if symmetric else len (ux) * len (uy)
+        answered = int (in_x.sum ()) * (int (in_x.sum ()) - 1) // 2 if symmetric else int (in_x.sum ()) * int (in_y.sum ())
+        stats = {'stage': stage, 'cutoff': threshold, 'requested_pairs': requested, 'answered_pairs': answered,
+                 'hit_rate': answered / requested if requested else 1., 'reused_hits': reused, 'computed_hits': len (cd)}
+        # a block the best one fully covers adds nothing
+        self._commit (ux, uy, symmetric, threshold, stage, ux[ci], uy[cj], cd, not (in_x.all () and in_y.all ()), stats)
+        print("# Distance cache [%s]: %.1f%% of %d pairs answered from cache, %d hits reused, %d computed" % (stage, 100. * stats['hit_rate'], requested, reused, len (cd)))
+
+        xi = np.concatenate (xi + [ci])
+        yi = np.concatenate (yi + [cj])
+        dd = np.concatenate (dd + [cd])
+        return self._expand (xi, yi, dd, x_inverse, y_inverse, codes_x, threshold, symmetric)
+    #end method
+
+    def close_rows (self, seqs_x, seqs_y, threshold, threads = 1, stage = "combine"):
+        # Mask over seqs_y: within threshold of at least one row of seqs_x. The
+        # pairs the best block holds are read from the cache; the other rows go
+        # through tn93_engine.any_neighbor, which stops on a row at its first
+        # hit. A row it does not find has no pair within threshold, so only the
+        # rows found need their full pair lists for the result to be stored as
+        # a complete x by y block that later runs answer from.
+        hx, hy = row_hashes (seqs_x), row_hashes (seqs_y)
+        ux, x_first = np.unique (hx, return_index = True)
+        uy, y_first, y_inverse = np.unique (hy, return_index = True, return_inverse = True)
+
+        in_x, in_y, i, j, d = self._read (ux, uy, False, threshold)
+        found = np.zeros (len (uy), dtype = bool)
+        found[j] = True
+        reused = int (found.sum ())
+
+        codes_x = tn93_engine.encode ([seqs_x[i] for i in x_first])
+        codes_y = tn93_engine.encode ([seqs_y[i] for i in y_first])
+        # a row present on both sides is never stored as a pair
+        i = _lookup (ux, uy)
+        same = np.nonzero ((i >= 0) & in_y & ~found)[0]
+        same = same[in_x[i[same]]]
+        if len (same):
+            found[same] = tn93_engine.paired_distances (codes_x[i[same]], codes_y[same], self.mode, self.min_overlap) <= threshold
+        #end if
+        # block rows not found yet against x outside the block, and y outside
+        # the block against all of x
+        rows = np.nonzero (in_y & ~found)[0]
+        if len (rows) and not in_x.all ():
+            found[rows] = tn93_engine.any_neighbor (codes_x[~in_x], codes_y[rows], threshold, threads, self.mode, self.min_overlap)
+        #end if
+        rows = np.nonzero (~in_y)[0]
+        if len (rows):
+            found[rows] = tn93_engine.any_neighbor (codes_x, codes_y[rows], threshold, threads, self.mode, self.min_overlap)
+        #end if
+
+        # complete the block: every pair of a found row outside the stored block
+        ci, cj, cd = [], [], []
+        rows = np.nonzero (found)[0]
+        if len (rows) and not (in_x.all () and in_y.all ()):
+            for ii, jj, d in tn93_engine.neighbor_blocks (codes_x, codes_y[rows], threshold, threads, self.mode, self.min_overlap):
+                jj = rows[jj]
+                keep = ~(in_x[ii] & in_y[jj]) & (ux[ii] != uy[jj])
+                ci.append (ii[keep])
+                cj.append (jj[keep])
+                cd.append (d[keep])
+            #end for
+        #end if
+        ci = np.concatenate (ci + [np.zeros (0, dtype = np.int64)])
+        cj = np.concatenate (cj + [np.zeros (0, dtype = np.int64)])
+        cd = np.concatenate (cd + [np.zeros (0)])
+
+        requested = len (ux) * len (uy)
+        answered = int (in_x.sum ()) * int (in_y.sum ())
+        stats = {'stage': stage, 'cutoff': threshold, 'requested_pairs': requested, 'answered_pairs': answered,
+                 'hit_rate': answered / requested if requested else 1., 'reused_hits': reused, 'computed_hits': len (cd)}
+        self._commit (ux, uy, False, threshold, stage, ux[ci], uy[cj], cd, not (in_x.all () and in_y.all ()), stats)
+        print("# Distance cache [%s]: %.1f%% of %d pairs answered from cache, %d rows found there, %d by any_neighbor" % (stage, 100. * stats['hit_rate'], requested, reused, int (found.sum ()) - reused))
+        return found[y_inverse]
+    #end method
+
+    def _write_manifest (self, manifest):
+        with open (self.manifest_file + ".tmp", "w") as fh:
+            json.dump (manifest, fh)
+        #end with
+        os.replace (self.manifest_file + ".tmp", self.manifest_file)
+    #end method
+
+    def _compact (self, manifest):
+        # Keep the newest MAX_BLOCKS blocks; rewrite pairs.bin with one record
+        # per pair whose rows are both in a kept block (every pair a kept block
+        # answers), and remove the dropped block files
+        if len (manifest['blocks']) <= MAX_BLOCKS:
+            return
+        #end if
+        dropped, kept = manifest['blocks'][:-MAX_BLOCKS], manifest['blocks'][-MAX_BLOCKS:]
+        hashes = np.unique (np.concatenate ([np.load (os.path.join (self.directory, block[side])) for block in kept for side in ('left', 'right') if block[side]]))
+        pairs = np.array (self._pairs (manifest['committed']))
+        pairs = np.unique (pairs[np.isin (pairs['a'], hashes) & np.isin (pairs['b'], hashes)])
+        pairs.tofile (self.pairs_file + ".tmp")
+        os.replace (self.pairs_file + ".tmp", self.pairs_file)
+        print("# Distance cache %s: dropped %d old blocks, %d of %d pair records kept" % (self.directory, len (dropped), len (pairs), manifest['committed']))
+        for block in dropped:
+            for side in ('left', 'right'):
+                if block[side] and os.path.exists (os.path.join (self.directory, block[side])):
+                    os.remove (os.path.join (self.directory, block[side]))
+                #end if
+            #end for
+        #end for
+        manifest['blocks'] = kept
+        manifest['committed'] = len (pairs)
+    #end method
+
+    def _expand (self, xi, yi, dd, x_inverse, y_inverse, codes_x, threshold, symmetric):
+        # Unique-row results back onto the input rows, duplicates included
+        rows_x = [[] for u in range (len (codes_x))]
+        for r, u in enumerate (x_inverse.tolist ()):
+            rows_x[u].append (r)
+        #end for
+        if symmetric:
+            rows_y = rows_x
+        else:
+            rows_y = [[] for u in range (int (y_inverse.max ()) + 1 if len (y_inverse) else 0)]
+            for r, u in enumerate (y_inverse.tolist ()):
+                rows_y[u].append (r)
+            #end for
+        #end if
+        result = set ()
+        for i, j, d in zip (xi.tolist (), yi.tolist (), dd.tolist ()):
+            for a in rows_x[i]:
+                for b in rows_y[j]:
+                    result.add ((min (a, b), max (a, b), d) if symmetric else (a, b, d))
+                #end for
+            #end for
+        #end for
+        # identical rows in the input: distance to itself
+        duplicated = [u for u, rows in enumerate (rows_x) if len (rows) > 1] if symmetric else []
+        if duplicated:
+            self_d = tn93_engine.paired_distances (codes_x[duplicated], codes_x[duplicated], self.mode, self.min_overlap)
+            for u, d in zip (duplicated, self_d.tolist ()):
+                if d <= threshold:
+                    rows = rows_x[u]
+                    result.update ((rows[p], rows[q], d) for p in range (len (rows)) for q in range (p + 1, len (rows)))
+                #end if
+            #end for
+        #end if
+        return sorted (result)
+    #end method
+#end class
+
+def summarize (directory):
+    # Hit rate per stage across every run recorded in the cache
+    totals = {}
+    with open (os.path.join (directory, "stats.jsonl")) as fh:
+        for line in fh:
+            s = json.loads (line)
+            t = totals.setdefault (s['stage'], [0, 0, 0])
+            t[0] += 1
+            t[1] += s['requested_pairs']
+            t[2] += s['answered_pairs']
+        #end for
+    #end with
+    print("| stage | runs | requested pairs | answered from cache | hit rate |")
+    print("|:---:|:---:|:---:|:---:|:---:|")
+    for stage, (runs, requested, answered) in sorted (totals.items ()):
+        print("| %s | %d | %d | %d | %.1f%% |" % (stage, runs, requested, answered, 100. * answered / requested if requested else 100.))
+    #end for
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Per-stage hit rates of a gene distance cache')
+    arguments.add_argument('-c', '--cache', help = 'Distance cache directory of one gene', required = True, type = str)
+    settings = arguments.parse_args()
+
+    summarize (settings.cache)
+    sys.exit(0)
+#end if
+
+# End of file
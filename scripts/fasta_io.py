@@ -0,0 +1,61 @@
+# FASTA helpers shared by the pipeline scripts
+
+# Imports -------------------------------------------------------------
+import gzip
+import lzma
+
+# Helper functions -----------------------------------------------------
+
+def open_input (filename, mode = "rb"):
+    # GISAID downloads may be left compressed, pick the codec from the suffix
+    if filename.endswith (".gz"):
+        return gzip.open (filename, mode)
+    elif filename.endswith (".xz"):
+        return lzma.open (filename, mode)
+    #end if
+    return open (filename, mode)
+#end method
+
+def read_fasta (filename):
+    # Streams (id, sequence) pairs, one record in memory at a time
+    seq_id = None
+    chunks = []
+    with open_input (filename, "rt") as fh:
+        for line in fh:
+            line = line.strip ()
+            if not line:
+                continue
+            #end if
+            if line[0] == '>':
+                if seq_id is not None:
+                    yield seq_id, "".join (chunks)
+                #end if
+                seq_id = line[1:]
+                chunks = []
+            else:
+                chunks.append (line)
+            #end if
+        #end for
+    #end with
+    if seq_id is not None:
+        yield seq_id, "".join (chunks)
+    #end if
+#end method
+
+def write_fasta (fh, seq_id, seq):
+    fh.write (">%s\n%s\n" % (seq_id, seq))
+#end method
+
+def first_record_name (filename):
+    # Same convention as the --reference_seq handling in tn93_cluster.py
+    with open (filename) as fh:
+        for l in fh:
+            if l[0] == '>':
+                return l[1:].split (' ')[0].strip()
+            #end if
+        #end for
+    #end with
+    return ""
+#end method
+
+# End of file
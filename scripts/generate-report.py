@@ -30,6 +30,8 @@ import operator
 from collections import defaultdict
 from pathlib import Path
 import glob
+from dedup import load_multiplicity
+from cluster_json import iter_clusters
 
 # =============================================================================
 # Declares
@@ -105,6 +107,14 @@ arguments.add_argument(
     required=False,
     type=str,
     default="Reference")
+arguments.add_argument(
+    '-m',
+    '--multiplicity',
+    help='id/hash/count tables written by dedup.py, used to count isolates per cluster',
+    required=False,
+    type=str,
+    nargs='*',
+    default=[])
 
 # =============================================================================
 # Process commandline arguments
@@ -168,6 +178,12 @@ if (import_settings.summary):
     # end try
 # end if
 
+multiplicity = {}
+for sidecar in import_settings.multiplicity:
+    print("# Opening multiplicity file:", sidecar)
+    multiplicity.update(load_multiplicity(sidecar))
+# end for
+
 # =============================================================================
 # Helper functions
 # =============================================================================
@@ -201,6 +217,27 @@ def load_reference_genome(ref_genome_dir):
     return genome
 #end method
 
+def load_cluster_counts(json_file):
+    global multiplicity
+
+    if not os.path.exists(json_file) or os.stat(json_file).st_size == 0:
+        return None
+    # end if
+
+    clusters = 0
+    isolates = 0
+    for c in iter_clusters(json_file):
+        clusters += 1
+        if 'size' in c:
+            isolates += c['size']
+        else:
+            isolates += sum(multiplicity.get(m, 1) for m in c['members'])
+        # end if
+    # end for
+    return {'clusters': clusters, 'isolates': isolates}
+# end method
+
+
 def newick_parser(nwk_str, bootstrap_values, track_tags, json_map):
     global tags
     clade_stack = []
@@ -1175,6 +1212,10 @@ for file_name in import_settings.file:
     # end for
     if summary_json is not None:
         summary_json[summary_json_key]['map'] = ref_seq_map
+        # Sequence counts reflect isolates, not the deduplicated representatives
+        summary_json[summary_json_key]['counts'] = {
+            'query': load_cluster_counts(os.path.join(results_dir, this_file + ".query.json")),
+            'background': load_cluster_counts(os.path.join(results_dir, this_file + ".background.json"))}
     # end if
 
     include_in_annotation = {}
@@ -0,0 +1,170 @@
+# Run a long HyPhy analysis with a per-gene checkpoint: completed model fits
+# are saved as HyPhy goes (--intermediate-fits) and reloaded when the job is
+# started again after a walltime kill or preemption. A manifest per analysis
+# records progress and checkpoint age; --summary lists them.
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import hashlib
+import argparse
+import subprocess
+
+# Declares
+# Arguments naming the files a checkpoint depends on
+INPUT_OPTIONS = ("--alignment", "--tree")
+
+# Helper functions -----------------------------------------------------
+
+def checkpoint_key (command):
+    # Same alignment, tree and options (thread count aside) -> same checkpoint
+    digest = hashlib.sha1 ()
+    for i, arg in enumerate (command):
+        if arg.startswith ("CPU="):
+            continue
+        #end if
+        digest.update (arg.encode () + b"\0")
+        if i > 0 and command[i - 1] in INPUT_OPTIONS and os.path.exists (arg):
+            with open (arg, "rb") as fh:
+                for chunk in iter (lambda: fh.read (1 << 20), b""):
+                    digest.update (chunk)
+                #end for
+            #end with
+        #end if
+    #end for
+    return digest.hexdigest ()[:12]
+#end method
+
+def saved_fits (filename):
+    # Number of model fits in a HyPhy intermediate-fits file
+    try:
+        with open (filename) as fh:
+            fits = json.load (fh)
+        #end with
+    except (OSError, ValueError):
+        return 0
+    #end try
+    return len (fits) if isinstance (fits, dict) else 0
+#end method
+
+def write_manifest (filename, manifest):
+    with open (filename + ".tmp", "w") as fh:
+        json.dump (manifest, fh, indent = 1)
+    #end with
+    os.replace (filename + ".tmp", filename)
+#end method
+
+def run (command, directory, analysis, resume_option, interval):
+    os.makedirs (directory, exist_ok = True)
+    key = checkpoint_key (command)
+    checkpoint = os.path.join (directory, "%s.%s.fits.json" % (analysis, key))
+    manifest_file = os.path.join (directory, analysis + ".manifest.json")
+
+    # checkpoints of older inputs can never be resumed
+    for stale in glob.glob (os.path.join (directory, analysis + ".*.fits.json")):
+        if stale != checkpoint:
+            os.remove (stale)
+        #end if
+    #end for
+    manifest = {}
+    if os.path.exists (manifest_file):
+        with open (manifest_file) as fh:
+            manifest = json.load (fh)
+        #end with
+    #end if
+    if manifest.get ('key') != key:
+        manifest = {'analysis': analysis, 'key': key, 'attempts': 0, 'first_start': time.time ()}
+    #end if
+    manifest['attempts'] += 1
+    manifest['resumed'] = os.path.exists (checkpoint) and saved_fits (checkpoint) > 0
+    manifest['resumable'] = bool (resume_option)
+    manifest['command'] = " ".join (command)
+    if resume_option:
+        command = command + [resume_option, checkpoint]
+    #end if
+    print("# %s attempt %d, %s" % (analysis, manifest['attempts'], "resuming from %d saved fits" % saved_fits (checkpoint) if manifest['resumed'] else "no checkpoint to resume"))
+
+    def update (status):
+        manifest['status'] = status
+        manifest['updated'] = time.time ()
+        manifest['saved_fits'] = saved_fits (checkpoint)
+        manifest['checkpoint_time'] = os.path.getmtime (checkpoint) if os.path.exists (checkpoint) else None
+        write_manifest (manifest_file, manifest)
+    #end nested method
+
+    process = subprocess.Popen (command)
+    # the batch system's SIGTERM (walltime, preemption) goes to HyPhy too;
+    # note it so the manifest says why the attempt ended
+    stopped = []
+    def forward (signum, frame):
+        stopped.append (signum)
+        process.send_signal (signum)
+    #end nested method
+    signal.signal (signal.SIGTERM, forward)
+    signal.signal (signal.SIGINT, forward)
+
+    update ("running")
+    while True:
+        try:
+            code = process.wait (timeout = interval)
+            break
+        except subprocess.TimeoutExpired:
+            update ("running")
+        #end try
+    #end while
+
+    if code == 0:
+        # the result JSON is written; the checkpoint has served its purpose
+        if os.path.exists (checkpoint):
+            os.remove (checkpoint)
+        #end if
+        update ("finished")
+    else:
+        update ("interrupted" if stopped else "failed (exit %d)" % code)
+    #end if
+    return code
+#end method
+
+def summary (root):
+    # One row per analysis manifest under ROOT (<root>/<gene>/<analysis>.manifest.json)
+    now = time.time ()
+    print("| gene | analysis | status | attempts | saved fits | checkpoint age h | last update h |")
+    print("|:---:|:---:|:---:|:---:|:---:|:---:|:---:|")
+    for filename in sorted (glob.glob (os.path.join (root, "*", "*.manifest.json"))):
+        with open (filename) as fh:
+            manifest = json.load (fh)
+        #end with
+        age = "%.1f" % ((now - manifest['checkpoint_time']) / 3600.) if manifest.get ('checkpoint_time') else "-"
+        print("| %s | %s | %s | %d | %d | %s | %.1f |" % (os.path.basename (os.path.dirname (filename)), manifest['analysis'], manifest.get ('status', '?'),
+              manifest['attempts'], manifest.get ('saved_fits', 0), age, (now - manifest.get ('updated', now)) / 3600.))
+    #end for
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Run a HyPhy analysis with a resumable per-gene checkpoint, or list checkpoint manifests')
+    arguments.add_argument('-c', '--checkpoint_dir', help = 'Per-gene checkpoint directory (cache/checkpoints/<label>/<gene>)', required = False, type = str)
+    arguments.add_argument('-a', '--analysis',       help = 'Analysis name, e.g. BUSTEDS-MH',                             required = False, type = str)
+    arguments.add_argument('--resume_option',        help = 'HyPhy option that saves / reloads model fits (empty: track only)', required = False, type = str, default = "--intermediate-fits")
+    arguments.add_argument('--interval',             help = 'Seconds between manifest updates',                           required = False, type = int, default = 600)
+    arguments.add_argument('--summary',              help = 'Checkpoint root (cache/checkpoints/<label>) to list',         required = False, type = str)
+    arguments.add_argument('command',                help = 'hyphy command line, after --',                               nargs = argparse.REMAINDER)
+    settings = arguments.parse_args()
+
+    if settings.summary:
+        summary (settings.summary)
+        sys.exit(0)
+    #end if
+    command = settings.command[1:] if settings.command[:1] == ["--"] else settings.command
+    if not (settings.checkpoint_dir and settings.analysis and command):
+        arguments.error ("--checkpoint_dir, --analysis and a command are required unless --summary is given")
+    #end if
+    sys.exit(run (command, settings.checkpoint_dir, settings.analysis, settings.resume_option, settings.interval))
+#end if
+
+# End of file
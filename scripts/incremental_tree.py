@@ -0,0 +1,229 @@
+# Incremental raxml-ng tree update: reuse last run's tree when few tips changed
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+import newick
+import tn93_engine
+
+# Declares
+task_runners = {}
+task_runners['raxml-ng'] = "raxml-ng"
+
+# Same as the original rule: GTR, three parsimony starting trees
+FULL_SEARCH = ['--tree', 'pars{3}']
+
+# Helper functions -----------------------------------------------------
+
+def run_command (exec, arguments, tag):
+    cmd = " ".join ([exec] + arguments)
+    print("# %s" % tag)
+    print(cmd)
+    result = os.system (cmd)
+    if result != 0:
+        print ('Command exection failed code %s' % result)
+        sys.exit(1)
+    #end if
+#end method
+
+def raxml (msa, prefix, threads, start = None, spr_radius = None, model = "GTR"):
+    # Tree search from parsimony starting trees, or a local search from START;
+    # returns (seconds, final log-likelihood)
+    arguments = ['--search', '--model', model, '--msa', msa, '--threads', str (threads), '--prefix', prefix, '--force']
+    if start:
+        arguments += ['--tree', start, '--spr-radius', str (spr_radius)]
+    else:
+        arguments += FULL_SEARCH
+    #end if
+    tick = time.perf_counter ()
+    run_command (task_runners['raxml-ng'], arguments, "raxml-ng %s search on %s" % ("local" if start else "full", msa))
+    return time.perf_counter () - tick, final_loglikelihood (prefix + ".raxml.log")
+#end method
+
+def final_loglikelihood (log_file):
+    value = float ('nan')
+    if os.path.exists (log_file):
+        with open (log_file) as fh:
+            for line in fh:
+                if line.startswith ("Final LogLikelihood:"):
+                    value = float (line.split (':')[1])
+                #end if
+            #end for
+        #end with
+    #end if
+    return value
+#end method
+
+def sequence_hashes (ids, seqs):
+    return dict ((i, hashlib.blake2b (s.upper ().encode (), digest_size = 8).hexdigest ()) for i, s in zip (ids, seqs))
+#end method
+
+def load_previous (cache_file):
+    if cache_file and os.path.exists (cache_file):
+        with open (cache_file) as fh:
+            return json.load (fh)
+        #end with
+    #end if
+    return None
+#end method
+
+def save_previous (cache_file, tree_file, hashes):
+    with open (tree_file) as fh:
+        tree = fh.read ().strip ()
+    #end with
+    os.makedirs (os.path.dirname (os.path.abspath (cache_file)), exist_ok = True)
+    with open (cache_file + ".tmp", "w") as fh:
+        json.dump ({'tree': tree, 'hashes': hashes}, fh)
+    #end with
+    os.replace (cache_file + ".tmp", cache_file)
+#end method
+
+# Parsimony placement --------------------------------------------------
+
+def _fitch (a, b):
+    # Fitch set of two state-set vectors (4-bit codes)
+    both = a & b
+    return np.where (both != 0, both, a | b)
+#end method
+
+def edge_sets (root, states):
+    # Per node, the Fitch set of the branch above it: the subtree below
+    # (down pass) merged with the rest of the tree (up pass)
+    order = newick.postorder (root)
+    down = {}
+    for node in order:
+        if node.is_leaf ():
+            down[node] = states[node.name]
+        else:
+            merged = down[node.children[0]]
+            for child in node.children[1:]:
+                merged = _fitch (merged, down[child])
+            #end for
+            down[node] = merged
+        #end if
+    #end for
+    up = {}
+    edges = {}
+    for node in reversed (order):
+        # siblings folded from the left and from the right, so multifurcations
+        # stay linear in their degree
+        children = node.children
+        left = [up.get (node)]
+        for child in children[:-1]:
+            left.append (down[child] if left[-1] is None else _fitch (left[-1], down[child]))
+        #end for
+        right = None
+        for k in range (len (children) - 1, -1, -1):
+            child = children[k]
+            rest = left[k] if right is None else (right if left[k] is None else _fitch (left[k], right))
+            up[child] = rest
+            edges[child] = down[child] if rest is None else _fitch (down[child], rest)
+            right = down[child] if right is None else _fitch (down[child], right)
+        #end for
+    #end for
+    return edges
+#end method
+
+def place (root, name, code, states):
+    # Attach NAME on the branch where it adds the fewest parsimony changes
+    edges = edge_sets (root, states)
+    nodes = list (edges)
+    costs = ((np.stack ([edges[node] for node in nodes]) & code) == 0).sum (axis = 1)
+    best = int (np.argmin (costs))
+    states[name] = code
+    newick.insert_on_edge (nodes[best], name, max (costs[best] / len (code), 1e-6))
+    return int (costs[best])
+#end method
+
+def start_tree (previous, ids, seqs, keep, added):
+    # Previous tree without the removed/changed tips, new tips added by
+    # stepwise parsimony placement
+    root = newick.parse (previous)
+    root = newick.prune (root, set (leaf.name for leaf in newick.leaves (root)) - keep)
+    codes = tn93_engine.encode (seqs)
+    # unknown / gap positions fit any state
+    codes[codes == 0] = 15
+    row = dict ((seq_id, k) for k, seq_id in enumerate (ids))
+    states = dict ((seq_id, codes[row[seq_id]]) for seq_id in keep)
+    changes = 0
+    for seq_id in added:
+        changes += place (root, seq_id, codes[row[seq_id]], states)
+    #end for
+    return root, changes
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Update last run\'s ML tree by parsimony placement and a local raxml-ng search')
+    arguments.add_argument('-m', '--msa',        help = 'Combined alignment ({GENE}.combined.fas)',             required = True, type = str)
+    arguments.add_argument('-o', '--output',     help = 'Tree to write ({GENE}.combined.fas.raxml.bestTree)',   required = True, type = str)
+    arguments.add_argument('-c', '--cache',      help = 'Previous tree and sequence hashes, updated on success', required = False, type = str)
+    arguments.add_argument('--max_change',       help = 'Full search when more than this fraction of tips were added, removed or changed (0 always searches)', required = False, type = float, default = 0.2)
+    arguments.add_argument('--spr_radius',       help = 'SPR radius of the local search',                       required = False, type = int, default = 5)
+    arguments.add_argument('-t', '--threads',    help = 'raxml-ng threads',                                     required = False, type = int, default = 1)
+    arguments.add_argument('--compare_full',     help = 'Also run the full search and report runtime and log-likelihood of both', action = 'store_true')
+    settings = arguments.parse_args()
+
+    ids, seqs = tn93_engine.read_alignment (settings.msa)
+    hashes = sequence_hashes (ids, seqs)
+    previous = load_previous (settings.cache) if settings.max_change > 0 else None
+    prefix = settings.output[:-len (".raxml.bestTree")] if settings.output.endswith (".raxml.bestTree") else settings.output
+
+    results = []
+    if previous:
+        keep = set (i for i, h in hashes.items () if previous['hashes'].get (i) == h)
+        added = [i for i in ids if i not in keep]
+        # changed tips are counted once, under added
+        removed = len (set (previous['hashes']) - set (ids))
+        fraction = (len (added) + removed) / max (len (ids), 1)
+        print("# %d tips kept, %d added or changed, %d removed (%.1f%% change)" % (len (keep), len (added), removed, 100. * fraction))
+        if fraction > settings.max_change or len (keep) < 3:
+            print("# Change above %.1f%%, running a full search" % (100. * settings.max_change))
+            previous = None
+        #end if
+    #end if
+
+    if previous:
+        tick = time.perf_counter ()
+        root, changes = start_tree (previous['tree'], ids, seqs, keep, added)
+        start = prefix + ".start.nwk"
+        with open (start, "w") as fh:
+            print (newick.write (root), file = fh)
+        #end with
+        print("# Placed %d tips with %d parsimony changes in %.2f s" % (len (added), changes, time.perf_counter () - tick))
+        seconds, loglik = raxml (settings.msa, prefix, settings.threads, start, settings.spr_radius)
+        results.append (("incremental", time.perf_counter () - tick, loglik))
+    else:
+        seconds, loglik = raxml (settings.msa, prefix, settings.threads)
+        results.append (("full", seconds, loglik))
+    #end if
+    if prefix + ".raxml.bestTree" != settings.output:
+        shutil.copy (prefix + ".raxml.bestTree", settings.output)
+    #end if
+
+    if settings.compare_full and results[0][0] != "full":
+        seconds, loglik = raxml (settings.msa, prefix + ".full", settings.threads)
+        results.append (("full", seconds, loglik))
+    #end if
+    print("| search | seconds | log-likelihood |")
+    print("|:---:|:---:|:---:|")
+    for search, seconds, loglik in results:
+        print("| %s | %.1f | %.4f |" % (search, seconds, loglik))
+    #end for
+
+    if settings.cache:
+        save_previous (settings.cache, settings.output, hashes)
+    #end if
+    sys.exit(0)
+#end if
+
+# End of file
@@ -0,0 +1,214 @@
+# Minimal Newick tree reading, writing and editing (tree update and annotation)
+
+# Imports -------------------------------------------------------------
+import re
+
+# Declares
+_token = re.compile (r"\s*('(?:[^']|'')*'|[(),:;]|[^(),:;]+)")
+_needs_quotes = re.compile (r"[\s(),:;'\[\]]")
+
+# Helper functions -----------------------------------------------------
+
+class Node:
+    def __init__ (self, name = "", length = None, parent = None):
+        self.name = name
+        self.length = length
+        self.parent = parent
+        self.children = []
+    #end method
+
+    def add (self, child):
+        child.parent = self
+        self.children.append (child)
+        return child
+    #end method
+
+    def is_leaf (self):
+        return not self.children
+    #end method
+#end class
+
+def parse (text):
+    # Iterative, so caterpillar-shaped trees do not hit the recursion limit
+    root = Node ()
+    node = root
+    expect_length = False
+    for token in _token.findall (text.strip ()):
+        token = token.strip ()
+        if token == '(':
+            node = node.add (Node ())
+        elif token == ',':
+            node = node.parent.add (Node ())
+        elif token == ')':
+            node = node.parent
+        elif token == ':':
+            expect_length = True
+            continue
+        elif token == ';':
+            break
+        elif expect_length:
+            node.length = float (token)
+        elif token[0] == "'":
+            node.name = token[1:-1].replace ("''", "'")
+        else:
+            node.name = token
+        #end if
+        expect_length = False
+    #end for
+    return root
+#end method
+
+def read (filename):
+    with open (filename) as fh:
+        return parse (fh.read ())
+    #end with
+#end method
+
+def quote (name):
+    if _needs_quotes.search (name):
+        return "'%s'" % name.replace ("'", "''")
+    #end if
+    return name
+#end method
+
+def write (root, label = None, lengths = True):
+    # LABEL (node -> text) replaces the node names, e.g. to add {branch set} tags
+    def _label (node):
+        text = label (node) if label else quote (node.name)
+        if lengths and node.length is not None:
+            text += ":%.10g" % node.length
+        #end if
+        return text
+    #end nested method
+    out = []
+    stack = [(root, False)]
+    while stack:
+        node, closing = stack.pop ()
+        if closing:
+            out.append (")" + _label (node))
+            continue
+        #end if
+        if out and out[-1] != "(":
+            out.append (",")
+        #end if
+        if node.children:
+            out.append ("(")
+            stack.append ((node, True))
+            stack.extend ((child, False) for child in reversed (node.children))
+        else:
+            out.append (_label (node))
+        #end if
+    #end while
+    return "".join (out) + ";"
+#end method
+
+def postorder (root):
+    # Children before parents
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop ()
+        order.append (node)
+        stack.extend (node.children)
+    #end while
+    return order[::-1]
+#end method
+
+def leaves (root):
+    return [node for node in postorder (root) if node.is_leaf ()]
+#end method
+
+def _splice (node):
+    # Remove a node with a single child, joining the two branches
+    child = node.children[0]
+    if node.parent is None:
+        return child
+    #end if
+    if node.length is not None or child.length is not None:
+        child.length = (node.length or 0.) + (child.length or 0.)
+    #end if
+    siblings = node.parent.children
+    siblings[siblings.index (node)] = child
+    child.parent = node.parent
+    return None
+#end method
+
+def prune (root, names):
+    # Drop the named leaves; unary nodes left behind are spliced out and the
+    # root is kept multifurcating (unrooted), as raxml-ng writes it
+    names = set (names)
+    for leaf in [leaf for leaf in leaves (root) if leaf.name in names]:
+        parent = leaf.parent
+        parent.children.remove (leaf)
+        while parent is not None and len (parent.children) == 1:
+            grandparent = parent.parent
+            new_root = _splice (parent)
+            if new_root is not None:
+                new_root.parent = None
+                new_root.length = None
+                root = new_root
+            #end if
+            parent = grandparent
+        #end while
+    #end for
+    return unroot (root)
+#end method
+
+def unroot (root):
+    # A bifurcating root becomes a trifurcation over one of its internal children
+    if len (root.children) == 2:
+        for i, child in enumerate (root.children):
+            if child.children:
+                other = root.children[1 - i]
+                other.length = (other.length or 0.) + (child.length or 0.)
+                root.children = [other]
+                for grandchild in child.children:
+                    root.add (grandchild)
+                #end for
+                other.parent = root
+                break
+            #end if
+        #end for
+    #end if
+    return root
+#end method
+
+def reroot (root, node):
+    # Re-hang the tree from NODE (reversing the branches on the path to the old
+    # root); the old root is spliced out if that leaves it with one child
+    path = []
+    while node is not None:
+        path.append (node)
+        node = node.parent
+    #end while
+    for child, parent in reversed (list (zip (path, path[1:]))):
+        parent.children.remove (child)
+        parent.length = child.length
+        child.add (parent)
+    #end for
+    new_root = path[0]
+    new_root.parent = None
+    new_root.length = None
+    old_root = path[-1]
+    if old_root is not new_root and len (old_root.children) == 1:
+        _splice (old_root)
+    #end if
+    return new_root
+#end method
+
+def insert_on_edge (node, name, length):
+    # New leaf NAME attached to the middle of the branch above NODE
+    parent = node.parent
+    if parent is None:
+        return node.add (Node (name, length))
+    #end if
+    half = node.length / 2. if node.length is not None else None
+    joint = Node ("", half)
+    parent.children[parent.children.index (node)] = joint
+    joint.parent = parent
+    node.length = half
+    joint.add (node)
+    return joint.add (Node (name, length))
+#end method
+
+# End of file
@@ -1,22 +1,29 @@
 #!/bin/bash
 #@Usage: bash scripts/process_json.sh {Working directory} {Folder in results}
 #@Usage: bash scripts/process_json.sh /data/shares/veg/aglucaci/RASCL-Influenza H3N2
+#@Usage: bash scripts/process_json.sh {Working directory} {Folder in results} final   (writes {TAG}_summary.final.json, ...)
 
 ## Declares
 BASEDIR=$1
 TAG=$2
+SUFFIX=${3:+.$3}
 
 DATA_DIR="$BASEDIR"/results/"$TAG"
 
 # Static settings
 REF_TAG="REFERENCE"
-ANNOTATION_JSON="$DATA_DIR"/"$TAG"_annotation.json
-SUMMARY_JSON="$DATA_DIR"/"$TAG"_summary.json
+ANNOTATION_JSON="$DATA_DIR"/"$TAG"_annotation"$SUFFIX".json
+SUMMARY_JSON="$DATA_DIR"/"$TAG"_summary"$SUFFIX".json
+
+# Multiplicity tables from the dedup stage, if any
+shopt -s nullglob
+MULTIPLICITY=("$DATA_DIR"/*.dedup.tsv)
+shopt -u nullglob
 
 for file in "$DATA_DIR"/*.combined.fas; do
    echo ""
-   echo python3 scripts/generate-report.py -f $file -A $ANNOTATION_JSON -S $SUMMARY_JSON -r "$REF_TAG"
-   python3 scripts/generate-report.py -f $file -A $ANNOTATION_JSON -S $SUMMARY_JSON -r "$REF_TAG"
+   echo python3 scripts/generate-report.py -f $file -A $ANNOTATION_JSON -S $SUMMARY_JSON -r "$REF_TAG" -m "${MULTIPLICITY[@]}"
+   python3 scripts/generate-report.py -f $file -A $ANNOTATION_JSON -S $SUMMARY_JSON -r "$REF_TAG" -m "${MULTIPLICITY[@]}"
 done
 
 exit 0
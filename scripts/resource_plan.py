@@ -0,0 +1,158 @@
+# Per-gene thread and memory plan for raxml-ng and each HyPhy analysis from the combined alignment
+
+# Imports -------------------------------------------------------------
+import sys
+import json
+import math
+import argparse
+
+import numpy as np
+
+from fasta_io import read_fasta
+
+# Declares
+# raxml-ng parallelises the likelihood over alignment patterns and stops
+# gaining from extra threads at a few hundred DNA patterns per thread
+RAXML_PATTERNS_PER_THREAD = 500
+
+# HyPhy analyses by how they use threads (CPU=):
+#   sites       - independent per-site fits handed out to workers; scales with
+#                 codon patterns, a few dozen per thread keep workers busy
+#   likelihood  - one global fit (optimisation from starting points, branch
+#                 tests run in turn); only the likelihood evaluation is split
+#                 over patterns, so returns flatten out beyond a few threads
+#   serial      - MCMC / counting, one or two threads are enough
+SCALING = {'sites': (25, None), 'likelihood': (100, 8), 'serial': (None, 1)}
+
+# rule: (scaling, rate classes held per pattern and node, for memory)
+ANALYSES = {
+    'slac':      ('serial',     1),
+    'bgm':       ('serial',     1),
+    'fel':       ('sites',      1),
+    'cfel':      ('sites',      2),
+    'meme':      ('sites',      2),
+    'meme_full': ('sites',      2),
+    'prime':     ('sites',      2),
+    'fade':      ('sites',      4),
+    'busted':    ('likelihood', 3),
+    'busteds':   ('likelihood', 9),
+    'bustedmh':  ('likelihood', 3),
+    'bustedsmh': ('likelihood', 9),
+    'relax':     ('likelihood', 9),
+    'relax_mh':  ('likelihood', 9),
+    'absrel':    ('likelihood', 2),
+    'absrels':   ('likelihood', 6),
+    'absrelmh':  ('likelihood', 2),
+    'absrelsmh': ('likelihood', 6),
+    'fmm':       ('likelihood', 3),
+    'fit_baseline': ('likelihood', 1),
+    'fit_baseline_clade': ('likelihood', 1),
+}
+
+# Conditional likelihood vectors: states x rate classes x 8 bytes, per
+# pattern and per node (about 2 nodes per tip), plus program overhead
+RAXML_CLV_BYTES = 4 * 4 * 8
+CODON_CLV_BYTES = 61 * 8
+# FADE works on the protein alignment: 20 states under 4 bias levels x 20 residues
+STATE_COUNT = {'fade': 20 * 20}
+RAXML_BASE_MB = 200
+HYPHY_BASE_MB = 1000
+
+# Helper functions -----------------------------------------------------
+
+def alignment_patterns (filename):
+    # (sequences, sites, nucleotide site patterns, codon site patterns)
+    rows = [seq.upper ().encode () for seq_id, seq in read_fasta (filename)]
+    if not rows:
+        return 0, 0, 0, 0
+    #end if
+    sites = max (len (r) for r in rows)
+    matrix = np.frombuffer (b"".join (r.ljust (sites, b'-') for r in rows), dtype = np.uint8).reshape (len (rows), sites)
+    patterns = len (np.unique (matrix.T, axis = 0))
+    codons = sites // 3
+    codon_columns = matrix[:, :codons * 3].reshape (len (rows), codons, 3).transpose (1, 0, 2).reshape (codons, -1)
+    codon_patterns = len (np.unique (codon_columns, axis = 0)) if codons else 0
+    return len (rows), sites, patterns, codon_patterns
+#end method
+
+def _threads (patterns, per_thread, cap, max_threads):
+    threads = math.ceil (patterns / per_thread) if per_thread else 1
+    return max (1, min (max_threads, cap or max_threads, threads))
+#end method
+
+def _mem_mb (patterns, sequences, clv_bytes, base_mb):
+    return int (base_mb + patterns * 2 * sequences * clv_bytes / 1e6)
+#end method
+
+def plan (filename, max_threads):
+    sequences, sites, patterns, codon_patterns = alignment_patterns (filename)
+    result = {'sequences': sequences, 'sites': sites, 'patterns': patterns, 'codon_patterns': codon_patterns,
+              'raxml': {'threads': _threads (patterns, RAXML_PATTERNS_PER_THREAD, None, max_threads),
+                        'mem_mb': _mem_mb (patterns, sequences, RAXML_CLV_BYTES, RAXML_BASE_MB)}}
+    for rule, (scaling, classes) in ANALYSES.items ():
+        per_thread, cap = SCALING[scaling]
+        clv_bytes = CODON_CLV_BYTES * classes * STATE_COUNT.get (rule, 61) // 61
+        # wanted_threads ignores the node size; split site analyses share it out
+        result[rule] = {'scaling': scaling,
+                        'threads': _threads (codon_patterns, per_thread, cap, max_threads),
+                        'wanted_threads': _threads (codon_patterns, per_thread, cap, codon_patterns or 1),
+                        'mem_mb': _mem_mb (codon_patterns, sequences, clv_bytes, HYPHY_BASE_MB)}
+    #end for
+    return result
+#end method
+
+def load_stats (filename):
+    # snakemake --stats: makespan, mean runtime per rule, and core-hours
+    # (duration x threads) over jobs; a job appears once per output file
+    with open (filename) as fh:
+        stats = json.load (fh)
+    #end with
+    jobs = {}
+    for record in stats.get ('files', {}).values ():
+        jobs[(record['start-time'], record['stop-time'])] = record['duration'] * record.get ('resources', {}).get ('_cores', 1)
+    #end for
+    means = dict ((rule, r['mean-runtime']) for rule, r in stats.get ('rules', {}).items ())
+    return stats.get ('total_runtime') or 0., means, sum (jobs.values ()) / 3600.
+#end method
+
+def compare_stats (before_file, after_file):
+    before_total, before, before_core_hours = load_stats (before_file)
+    after_total, after, after_core_hours = load_stats (after_file)
+    print("| rule | mean s before | mean s after |")
+    print("|:---:|:---:|:---:|")
+    for rule in sorted (set (before) | set (after)):
+        print("| %s | %.1f | %.1f |" % (rule, before.get (rule, 0.), after.get (rule, 0.)))
+    #end for
+    print("| **makespan s** | %.1f | %.1f |" % (before_total, after_total))
+    print("| **core-hours** | %.2f | %.2f |" % (before_core_hours, after_core_hours))
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Per-gene raxml-ng / HyPhy analysis threads and memory from alignment size and site patterns')
+    arguments.add_argument('-m', '--msa',          help = 'Combined alignment ({GENE}.combined.fas)',                  required = False, type = str)
+    arguments.add_argument('-o', '--output',       help = 'Plan to write ({GENE}.resources.json)',                     required = False, type = str)
+    arguments.add_argument('--max_threads',        help = 'Cores per node (ppn in cluster.json)',                      required = False, type = int, default = 16)
+    arguments.add_argument('--compare',            help = 'Two snakemake --stats files (before, after): makespan and per-rule runtime', required = False, type = str, nargs = 2)
+    settings = arguments.parse_args()
+
+    if settings.compare:
+        compare_stats (*settings.compare)
+        sys.exit(0)
+    #end if
+    if not (settings.msa and settings.output):
+        arguments.error ("--msa and --output are required unless --compare is given")
+    #end if
+    result = plan (settings.msa, settings.max_threads)
+    with open (settings.output, "w") as fh:
+        json.dump (result, fh, indent = 1)
+    #end with
+    print("# %s: %d sequences, %d patterns (%d codon patterns)" % (settings.msa, result['sequences'], result['patterns'], result['codon_patterns']))
+    for step in ['raxml'] + sorted (ANALYSES):
+        print("#   %-10s %2d threads %6d MB" % (step, result[step]['threads'], result[step]['mem_mb']))
+    #end for
+    sys.exit(0)
+#end if
+
+# End of file
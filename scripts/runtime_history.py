@@ -0,0 +1,99 @@
+# Runtime history per (rule, gene) from snakemake benchmark files, used to
+# decide which per-gene analyses are short enough to share one cluster job
+
+# Imports -------------------------------------------------------------
+import os
+import sys
+import csv
+import glob
+import argparse
+import statistics
+
+# Declares
+# Runs remembered per (rule, gene); the median of these is the estimate
+KEEP_RUNS = 5
+FIELDS = ["rule", "gene", "seconds", "last_benchmark"]
+
+# Helper functions -----------------------------------------------------
+
+def load_history (filename):
+    # {(rule, gene): ([seconds, ...], mtime of the last benchmark read)}
+    history = {}
+    if filename and os.path.exists (filename):
+        with open (filename) as fh:
+            for row in csv.DictReader (fh, delimiter = '\t'):
+                history[(row['rule'], row['gene'])] = ([float (s) for s in row['seconds'].split (',') if s], float (row['last_benchmark']))
+            #end for
+        #end with
+    #end if
+    return history
+#end method
+
+def median_seconds (history):
+    return dict ((key, statistics.median (seconds)) for key, (seconds, mtime) in history.items () if seconds)
+#end method
+
+def read_benchmark (filename):
+    # Mean wall-clock seconds ("s" column) over the repeats in one benchmark file
+    with open (filename) as fh:
+        values = [float (row['s']) for row in csv.DictReader (fh, delimiter = '\t')]
+    #end with
+    return sum (values) / len (values) if values else None
+#end method
+
+def update_history (history, benchmark_dir):
+    # Benchmarks are named {GENE}.{rule}.tsv; each file is read once per change
+    # of its mtime, which is saved with repr so it reads back exactly
+    added = 0
+    for filename in glob.glob (os.path.join (benchmark_dir, "*.tsv")):
+        gene, _, rule = os.path.basename (filename)[:-len (".tsv")].rpartition ('.')
+        mtime = os.path.getmtime (filename)
+        seconds, last = history.get ((rule, gene), ([], 0.))
+        if not gene or mtime <= last:
+            continue
+        #end if
+        value = read_benchmark (filename)
+        if value is not None:
+            history[(rule, gene)] = ((seconds + [value])[-KEEP_RUNS:], mtime)
+            added += 1
+        #end if
+    #end for
+    return added
+#end method
+
+def save_history (filename, history):
+    os.makedirs (os.path.dirname (os.path.abspath (filename)), exist_ok = True)
+    with open (filename + ".tmp", "w") as fh:
+        writer = csv.DictWriter (fh, FIELDS, delimiter = '\t')
+        writer.writeheader ()
+        for (rule, gene), (seconds, mtime) in sorted (history.items ()):
+            writer.writerow ({'rule': rule, 'gene': gene, 'seconds': ",".join ("%.1f" % s for s in seconds), 'last_benchmark': repr (mtime)})
+        #end for
+    #end with
+    os.replace (filename + ".tmp", filename)
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Fold snakemake benchmark files into the per-rule, per-gene runtime history')
+    arguments.add_argument('-b', '--benchmarks', help = 'Benchmark directory (benchmarks/<label>)',  required = True, type = str)
+    arguments.add_argument('-o', '--history',    help = 'Runtime history TSV, updated in place',     required = True, type = str)
+    arguments.add_argument('--short',            help = 'Also list (rule, gene) pairs with a median at or below this many seconds', required = False, type = float)
+    settings = arguments.parse_args()
+
+    history = load_history (settings.history)
+    added = update_history (history, settings.benchmarks)
+    save_history (settings.history, history)
+    print("# Added %d benchmarks, %d rule/gene pairs in %s" % (added, len (history), settings.history))
+    if settings.short is not None:
+        for (rule, gene), seconds in sorted (median_seconds (history).items ()):
+            if seconds <= settings.short:
+                print("%s\t%s\t%.1f" % (rule, gene, seconds))
+            #end if
+        #end for
+    #end if
+    sys.exit(0)
+#end if
+
+# End of file
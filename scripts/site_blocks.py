@@ -0,0 +1,231 @@
+# Split an alignment into codon blocks for site-level HyPhy analyses (FEL,
+# MEME, FADE), merge the per-block result JSONs into one with the layout of a
+# whole-gene run, and compare a merged result with a whole-gene one
+
+# Imports -------------------------------------------------------------
+import sys
+import json
+import math
+import argparse
+
+from fasta_io import read_fasta
+
+# Declares
+# The Snakefile makes no blocks shorter than this. Each block refits the
+# nucleotide GTR and MG94 models on its own columns, and below about a hundred
+# codons those estimates (and the site tests conditioned on them) are noise
+MIN_BLOCK_CODONS = 100
+
+# Helper functions -----------------------------------------------------
+
+def block_bounds (sites, blocks):
+    # Even [start, end) ranges over SITES columns (codons or residues)
+    blocks = max (1, min (blocks, sites))
+    return [(round (i * sites / blocks), round ((i + 1) * sites / blocks)) for i in range (blocks)]
+#end method
+
+def split_alignment (filename, blocks, prefix, width):
+    # WIDTH characters per site: 3 for codon alignments, 1 for protein
+    records = list (read_fasta (filename))
+    sites = max (len (seq) for seq_id, seq in records) // width if records else 0
+    bounds = block_bounds (sites, blocks)
+    for k, (start, end) in enumerate (bounds):
+        with open ("%sblock%d.fas" % (prefix, k + 1), "w") as fh:
+            for seq_id, seq in records:
+                fh.write (">%s\n%s\n" % (seq_id, seq[start * width:end * width]))
+            #end for
+        #end with
+    #end for
+    return bounds
+#end method
+
+def _merge (values, sites, path):
+    # VALUES holds the same entry from each block, SITES the block lengths
+    first = values[0]
+    if path == ("MLE", "headers"):
+        # column names, the same in every block whatever its length
+        return first
+    #end if
+    if isinstance (first, dict):
+        keys = list (first)
+        for value in values[1:]:
+            keys.extend (key for key in value if key not in keys)
+        #end for
+        return dict ((key, _merge ([v[key] for v in values if key in v], [s for v, s in zip (values, sites) if key in v], path + (key,))) for key in keys)
+    #end if
+    if isinstance (first, list):
+        if all (isinstance (v, list) and len (v) == s for v, s in zip (values, sites)):
+            return [row for value in values for row in value]
+        #end if
+        if all (isinstance (v, list) and len (v) == len (first) for v in values):
+            return [_merge ([v[i] for v in values], sites, path) for i in range (len (first))]
+        #end if
+        return first
+    #end if
+    if all (v == first for v in values):
+        return first
+    #end if
+    if isinstance (first, (int, float)) and not isinstance (first, bool) and path and path[0] == "branch attributes":
+        # per-branch estimates (lengths, rates): mean weighted by block length
+        return sum (v * s for v, s in zip (values, sites)) / sum (sites)
+    #end if
+    return first
+#end method
+
+def merge_results (filenames, output, alignment = None):
+    blocks = []
+    for filename in filenames:
+        with open (filename) as fh:
+            blocks.append (json.load (fh))
+        #end with
+    #end for
+    sites = [block['input']['number of sites'] for block in blocks]
+    total = sum (sites)
+
+    merged = {}
+    for key in blocks[0]:
+        values = [block[key] for block in blocks]
+        if key in ('MLE', 'branch attributes', 'site annotations'):
+            merged[key] = _merge (values, sites, (key,))
+        elif key == 'timers':
+            merged[key] = dict ((name, dict (timer, timer = sum (b[key].get (name, {}).get ('timer', 0) for b in blocks))) for name, timer in values[0].items ())
+        elif key == 'fits':
+            merged[key] = _merge_fits (values, total)
+        else:
+            merged[key] = values[0]
+        #end if
+    #end for
+    merged['input'] = dict (blocks[0]['input'], **{'number of sites': total})
+    if alignment:
+        merged['input']['file name'] = alignment
+    #end if
+    merged['site blocks'] = {'sites': sites,
+                             'fits': 'log likelihood, estimated parameters and AIC-c summed over independently fitted blocks',
+                             'branch attributes': 'means over blocks weighted by block length'}
+    if 'data partitions' in merged:
+        for partition in merged['data partitions'].values ():
+            partition['coverage'] = [list (range (total))]
+        #end for
+    #end if
+    with open (output, "w") as fh:
+        json.dump (merged, fh, indent = 1)
+    #end with
+    return sites
+#end method
+
+def _merge_fits (values, total):
+    # Blocks are fitted independently, so the joint log likelihood and the
+    # parameter count add up; AIC-c is recomputed from them. Each fit records
+    # how many blocks it sums, it is not the fit of a whole-gene run
+    fits = {}
+    for model, fit in values[0].items ():
+        fit = dict (fit, **{'summed over site blocks': len (values)})
+        if all (model in v and 'Log Likelihood' in v[model] for v in values):
+            log_l = sum (v[model]['Log Likelihood'] for v in values)
+            k = sum (v[model].get ('estimated parameters', 0) for v in values)
+            fit['Log Likelihood'] = log_l
+            fit['estimated parameters'] = k
+            if 'AIC-c' in fit and total - k - 1 > 0:
+                fit['AIC-c'] = -2 * log_l + 2 * k * total / (total - k - 1)
+            #end if
+        #end if
+        fits[model] = fit
+    #end for
+    return fits
+#end method
+
+# Parity with a whole-gene run ----------------------------------------------
+
+def _layout (value, path = ()):
+    # Key paths and list lengths, the part of a result generate-report.py relies on
+    if isinstance (value, dict):
+        return set ().union (*(_layout (v, path + (k,)) for k, v in value.items ())) if value else {path}
+    #end if
+    if isinstance (value, list):
+        return {path + ("[%d]" % len (value),)}
+    #end if
+    return {path}
+#end method
+
+def _site_tables (result):
+    # {name: per-site rows} from MLE.content, one level of nesting for FADE
+    tables = {}
+    for key, value in result['MLE']['content'].items ():
+        if isinstance (value, list):
+            tables[key] = value
+        else:
+            for partition, rows in value.items ():
+                tables[key + "/" + partition] = rows
+            #end for
+        #end if
+    #end for
+    return tables
+#end method
+
+def parity (whole_file, merged_file, column, cutoff, above = False):
+    # A site is called when its COLUMN value is <= CUTOFF (p-value), or >= it
+    # with ABOVE (FADE Bayes factor)
+    with open (whole_file) as fh:
+        whole = json.load (fh)
+    #end with
+    with open (merged_file) as fh:
+        merged = json.load (fh)
+    #end with
+    # branch attribute names are the same in both, so compare the MLE part
+    # and the list lengths; branch-level scalars differ by construction
+    layout = _layout ({'MLE': whole['MLE'], 'input': whole['input']}) ^ _layout ({'MLE': merged['MLE'], 'input': merged['input']})
+    print("| table | sites | max abs difference | calls (%s %g) whole | merged | disagreeing sites |" % (">=" if above else "<=", cutoff))
+    print("|:---:|:---:|:---:|:---:|:---:|:---:|")
+    whole_tables, merged_tables = _site_tables (whole), _site_tables (merged)
+    for name in sorted (whole_tables):
+        a, b = whole_tables[name], merged_tables.get (name, [])
+        difference = max ((abs (x - y) for row_a, row_b in zip (a, b) for x, y in zip (row_a, row_b)
+                           if isinstance (x, (int, float)) and isinstance (y, (int, float)) and math.isfinite (x) and math.isfinite (y)), default = 0.)
+        called = lambda row: row[column] >= cutoff if above else row[column] <= cutoff
+        calls_a = set (i for i, row in enumerate (a) if called (row))
+        calls_b = set (i for i, row in enumerate (b) if called (row))
+        print("| %s | %d / %d | %.4g | %d | %d | %d |" % (name, len (a), len (b), difference, len (calls_a), len (calls_b), len (calls_a ^ calls_b)))
+    #end for
+    for path in sorted (layout):
+        print("# Layout differs at: %s" % "/".join (path))
+    #end for
+    return not layout
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Split alignments into site blocks for FEL / MEME / FADE and merge the block results')
+    arguments.add_argument('-m', '--msa',        help = 'Alignment to split',                                    required = False, type = str)
+    arguments.add_argument('-p', '--prefix',     help = 'Block file prefix, writes <prefix>block<k>.fas',         required = False, type = str)
+    arguments.add_argument('-b', '--blocks',     help = 'Number of blocks',                                      required = False, type = int, default = 1)
+    arguments.add_argument('--protein',          help = 'The alignment is protein (one column per site)',        action = 'store_true')
+    arguments.add_argument('--merge',            help = 'Block result JSONs, in block order',                    required = False, type = str, nargs = '+')
+    arguments.add_argument('-o', '--output',     help = 'Merged result JSON',                                    required = False, type = str)
+    arguments.add_argument('--parity',           help = 'Whole-gene and merged result JSONs to compare',          required = False, type = str, nargs = 2)
+    arguments.add_argument('--column',           help = 'MLE column to call sites on (FEL 4, MEME 6 = p-value; FADE -1 = Bayes factor)', required = False, type = int, default = 4)
+    arguments.add_argument('--cutoff',           help = 'Call sites at or below this value (p-value)',           required = False, type = float, default = 0.05)
+    arguments.add_argument('--above',            help = 'Call sites at or above --cutoff instead (Bayes factor)', action = 'store_true')
+    settings = arguments.parse_args()
+
+    if settings.parity:
+        same = parity (settings.parity[0], settings.parity[1], settings.column, settings.cutoff, settings.above)
+        sys.exit(0 if same else 1)
+    #end if
+    if settings.merge:
+        if not settings.output:
+            arguments.error ("--merge needs --output")
+        #end if
+        sites = merge_results (settings.merge, settings.output, settings.msa)
+        print("# Merged %d blocks (%s sites) into %s" % (len (sites), "+".join (str (s) for s in sites), settings.output))
+        sys.exit(0)
+    #end if
+    if not (settings.msa and settings.prefix):
+        arguments.error ("--msa and --prefix are required unless --merge or --parity is given")
+    #end if
+    bounds = split_alignment (settings.msa, settings.blocks, settings.prefix, 1 if settings.protein else 3)
+    print("# %s: %d blocks, sites %s" % (settings.msa, len (bounds), ", ".join ("%d-%d" % (start + 1, end) for start, end in bounds)))
+    sys.exit(0)
+#end if
+
+# End of file
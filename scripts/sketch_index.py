@@ -0,0 +1,327 @@
+# MinHash sketch index over background sequences: candidate pairs for exact TN93
+
+# Imports -------------------------------------------------------------
+import os
+import re
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tn93_engine
+
+# Declares
+# Sketches are taken over aligned column windows: the k-mer starting at column
+# p is hashed together with p, and windows touching a gap or an ambiguity are
+# skipped, so struck codons and truncated ends only remove windows instead of
+# creating new junction k-mers. One-permutation MinHash splits the hash range
+# into ROWS * BANDS bins; a pair becomes a candidate when all rows of at least
+# one band agree (LSH banding).
+KMER_SIZE = 16
+BANDS = 16
+TARGET_RECALL = 0.999
+# Rows sized for pairs that share most of the alignment keep the sketch
+# selective; rows covering less than this fraction of it are compared exactly
+MIN_COVERAGE = 0.95
+
+_base_lut = np.full (256, 255, dtype = np.uint8)
+for i, c in enumerate ("ACGT"):
+    _base_lut[ord (c)] = i
+    _base_lut[ord (c.lower ())] = i
+#end for
+
+_empty_bin = np.iinfo (np.uint64).max
+_gap_run = re.compile (r"[^-]-")
+
+# Helper functions -----------------------------------------------------
+
+def _mix (x):
+    # splitmix64 finalizer, wrapping uint64 arithmetic
+    x = (x ^ (x >> np.uint64 (30))) * np.uint64 (0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64 (27))) * np.uint64 (0x94d049bb133111eb)
+    return x ^ (x >> np.uint64 (31))
+#end method
+
+def _matrix (seqs, length):
+    # (n_seqs x length) 2-bit base codes, 255 for gaps, ambiguities and padding
+    padded = "".join (s[:length].ljust (length, '-') for s in seqs)
+    return _base_lut[np.frombuffer (padded.encode (), dtype = np.uint8)].reshape (len (seqs), length)
+#end method
+
+def window_codes (bases, k = KMER_SIZE):
+    # 2-bit packed k-mer starting at every column, and whether it is free of
+    # gaps / ambiguities; k must be a power of two <= 32
+    if k & (k - 1) or not 0 < k <= 32:
+        raise ValueError ("k-mer size must be a power of two up to 32, not %d" % k)
+    #end if
+    n = bases.shape[1] - k + 1
+    if n <= 0:
+        return np.zeros ((bases.shape[0], 0), dtype = np.uint64), np.zeros ((bases.shape[0], 0), dtype = bool)
+    #end if
+    invalid = np.concatenate ((np.zeros ((bases.shape[0], 1), dtype = np.int32), np.cumsum (bases == 255, axis = 1, dtype = np.int32)), axis = 1)
+    valid = (invalid[:, k:] - invalid[:, :n]) == 0
+    # pack by doubling: 1-mers -> 2-mers -> 4-mers ... -> k-mers
+    packed = (bases & 3).astype (np.uint64)
+    width = 1
+    while width < k:
+        packed = (packed[:, :-width] << np.uint64 (2 * width)) | packed[:, width:]
+        width *= 2
+    #end while
+    return packed[:, :n], valid
+#end method
+
+def coverage (seqs):
+    # Unambiguous bases per sequence
+    return np.array ([sum (seq.upper ().count (b) for b in "ACGT") for seq in seqs], dtype = np.int64)
+#end method
+
+def gap_runs (seqs):
+    # Interior gap runs per covered column (struck codons, deletions), ends excluded
+    runs = covered = 0
+    for seq in seqs:
+        core = seq.strip ('-')
+        runs += len (_gap_run.findall (core))
+        covered += len (core)
+    #end for
+    return runs / covered if covered else 0.
+#end method
+
+def rows_for_overlap (threshold, length, overlap, gap_rate = 0., k = KMER_SIZE, bands = BANDS, target = TARGET_RECALL):
+    # Most rows per band that still makes a pair at 1.5 x threshold sharing
+    # OVERLAP of LENGTH columns a candidate with probability >= target. Each
+    # substitution and each gap run in either row disturbs up to k windows;
+    # windows outside the overlap are in the union but never shared.
+    changed = min (overlap, (1.5 * threshold + 2. * gap_rate) * overlap * k)
+    jaccard = max (0., (overlap - changed) / (length + changed))
+    rows = 1
+    while rows < 64 and 1. - (1. - jaccard ** (rows + 1)) ** bands >= target:
+        rows += 1
+    #end while
+    return rows
+#end method
+
+def signatures (seqs, length, n_bins, k = KMER_SIZE, seed = 1, chunk = 1024):
+    # (n_seqs x n_bins) one-permutation MinHash of positional windows, CHUNK
+    # sequences at a time
+    n_windows = max (0, length - k + 1)
+    sig = np.full ((len (seqs), n_bins), _empty_bin, dtype = np.uint64)
+    with np.errstate (over = 'ignore'):
+        positions = _mix (np.arange (n_windows, dtype = np.uint64) ^ _mix (np.uint64 (seed)))
+    #end with
+    for start in range (0, len (seqs), chunk):
+        codes, valid = window_codes (_matrix (seqs[start:start + chunk], length), k)
+        with np.errstate (over = 'ignore'):
+            hashed = _mix (codes ^ positions)[valid]
+        #end with
+        owner = np.nonzero (valid)[0]
+        key = owner * n_bins + ((hashed >> np.uint64 (32)) % np.uint64 (n_bins)).astype (np.int64)
+        np.minimum.at (sig[start:start + chunk].reshape (-1), key, hashed)
+    #end for
+    return sig
+#end method
+
+def band_keys (sig, bands):
+    # One 64-bit key per (sequence, band)
+    rows = sig.shape[1] // bands
+    banded = sig[:, :rows * bands].reshape (sig.shape[0], bands, rows)
+    key = np.zeros (banded.shape[:2], dtype = np.uint64)
+    with np.errstate (over = 'ignore'):
+        for r in range (rows):
+            key = _mix (key ^ banded[:, :, r])
+        #end for
+    #end with
+    return key
+#end method
+
+class SketchIndex:
+    def __init__ (self, seqs, threshold, k = KMER_SIZE, bands = BANDS, min_coverage = MIN_COVERAGE, seed = 1):
+        self.length = max ((len (s) for s in seqs), default = 0)
+        self.k = k
+        self.bands = bands
+        self.seed = seed
+        self.size = len (seqs)
+        # rows at or above the floor overlap by at least 2 x floor - length
+        self.floor = int (min_coverage * self.length)
+        self.rows = rows_for_overlap (threshold, max (self.length, 1), max (2 * self.floor - self.length, 1), gap_runs (seqs), k, bands)
+        self.sketched = np.nonzero (coverage (seqs) >= self.floor)[0]
+        keys = band_keys (signatures ([seqs[j] for j in self.sketched], self.length, self.rows * bands, k, seed), bands)
+        # per band, sketched background indices sorted by key
+        self.order = np.argsort (keys, axis = 0, kind = 'stable')
+        self.sorted_keys = np.take_along_axis (keys, self.order, axis = 0)
+    #end method
+
+    def candidates (self, query_seqs):
+        # Unique (query index, background index) pairs sharing at least one
+        # band; only queries and background rows above the coverage floor
+        queries = np.nonzero (coverage (query_seqs) >= self.floor)[0]
+        keys = band_keys (signatures ([query_seqs[i] for i in queries], self.length, self.rows * self.bands, self.k, self.seed), self.bands)
+        pairs = []
+        for b in range (self.bands):
+            lo = np.searchsorted (self.sorted_keys[:, b], keys[:, b], side = 'left')
+            hi = np.searchsorted (self.sorted_keys[:, b], keys[:, b], side = 'right')
+            counts = hi - lo
+            qi = np.repeat (queries, counts)
+            offsets = np.arange (counts.sum ()) - np.repeat (np.cumsum (counts) - counts, counts)
+            bj = self.sketched[self.order[np.repeat (lo, counts) + offsets, b]]
+            pairs.append (qi * self.size + bj)
+        #end for
+        pairs = np.unique (np.concatenate (pairs + [np.zeros (0, dtype = np.int64)]))
+        return pairs // max (self.size, 1), pairs % max (self.size, 1)
+    #end method
+#end class
+
+def close_pairs (query_codes, background_codes, qi, bj, threshold, threads = 1, block = 4096):
+    # Mask over candidate pairs (qi[p], bj[p]) within threshold. As in
+    # tn93_engine.any_neighbor, exact TN93 only runs on pairs whose p-distance
+    # lower bound (no compatible resolution at a shared site) passes.
+    def run (span):
+        s, e = span
+        a, b = query_codes[qi[s:e]], background_codes[bj[s:e]]
+        both = (a != 0) & (b != 0)
+        shared = np.count_nonzero (both, axis = 1)
+        mismatched = shared - np.count_nonzero (a & b, axis = 1)
+        keep = np.nonzero ((mismatched <= threshold * shared) & (shared >= tn93_engine.MIN_OVERLAP))[0]
+        close = np.zeros (e - s, dtype = bool)
+        if len (keep):
+            close[keep] = tn93_engine.paired_distances (a[keep], b[keep]) <= threshold
+        #end if
+        return close
+    #end nested method
+
+    with ThreadPoolExecutor (max_workers = max (1, threads)) as pool:
+        return np.concatenate ([np.zeros (0, dtype = bool)] + list (pool.map (run, tn93_engine._blocks (len (qi), block))))
+    #end with
+#end method
+
+def close_background (query_seqs, background_seqs, threshold, index = None, threads = 1, **kwargs):
+    # Background indices within threshold of any query: exact TN93 on sketch
+    # candidates, and on every pair involving a row below the coverage floor.
+    # Returns the set and the number of pairs compared exactly.
+    index = index or SketchIndex (background_seqs, threshold, **kwargs)
+    query_codes = tn93_engine.encode (query_seqs)
+    background_codes = tn93_engine.encode (background_seqs)
+    close = set ()
+    qi, bj = index.candidates (query_seqs)
+    if len (qi):
+        close.update (bj[close_pairs (query_codes, background_codes, qi, bj, threshold, threads)].tolist ())
+    #end if
+    compared = len (qi)
+    # partial rows: short background against all queries, short queries
+    # against the background rows not found yet
+    short_background = np.setdiff1d (np.arange (len (background_seqs)), index.sketched)
+    short_query = np.nonzero (coverage (query_seqs) < index.floor)[0]
+    if len (short_background) and len (query_seqs):
+        found = tn93_engine.any_neighbor (query_codes, background_codes[short_background], threshold, threads)
+        close.update (short_background[found].tolist ())
+        compared += len (query_seqs) * len (short_background)
+    #end if
+    open_rows = np.array (sorted (set (index.sketched.tolist ()) - close), dtype = np.int64)
+    if len (short_query) and len (open_rows):
+        found = tn93_engine.any_neighbor (query_codes[short_query], background_codes[open_rows], threshold, threads)
+        close.update (open_rows[found].tolist ())
+        compared += len (short_query) * len (open_rows)
+    #end if
+    return close, compared
+#end method
+
+def close_background_exhaustive (query_seqs, background_seqs, threshold, threads = 1):
+    close = set ()
+    for i, j, d in tn93_engine.neighbors (tn93_engine.encode (query_seqs), tn93_engine.encode (background_seqs), threshold, threads):
+        close.add (j)
+    #end for
+    return close
+#end method
+
+def check_recall (query_seqs, background_seqs, threshold, threads = 1, label = "", **kwargs):
+    start = time.perf_counter ()
+    index = SketchIndex (background_seqs, threshold, **kwargs)
+    sketched, n_compared = close_background (query_seqs, background_seqs, threshold, index, threads)
+    sketch_time = time.perf_counter () - start
+    start = time.perf_counter ()
+    exhaustive = close_background_exhaustive (query_seqs, background_seqs, threshold, threads)
+    exhaustive_time = time.perf_counter () - start
+    recall = len (sketched & exhaustive) / len (exhaustive) if exhaustive else 1.
+    return {'label': label, 'query': len (query_seqs), 'background': len (background_seqs), 'candidates': n_compared,
+            'exhaustive_pairs': len (query_seqs) * len (background_seqs), 'recall': recall, 'rows': index.rows,
+            'excluded': len (exhaustive), 'sketch_seconds': sketch_time, 'exhaustive_seconds': exhaustive_time}
+#end method
+
+def synthetic_sets (reference_seq, n_background, n_query, distance, struck = 0, truncated = 0., seed = 1):
+    # Background evolved from a bundled gene reference by repeated copying with
+    # a few substitutions, queries drawn close to random background sequences.
+    # Like real .msa.SA rows, STRUCK codons per sequence can be replaced by ---
+    # and a TRUNCATED fraction of rows can miss up to half the gene at the 5' end.
+    rng = np.random.default_rng (seed)
+    length = len (reference_seq)
+    def mutate (seq, expected):
+        seq = list (seq)
+        for site in rng.choice (length, min (length, rng.poisson (expected)), replace = False):
+            seq[site] = "ACGT"[("ACGT".find (seq[site]) + rng.integers (1, 4)) % 4]
+        #end for
+        return "".join (seq)
+    #end nested method
+    def damage (seq):
+        seq = list (seq)
+        for codon in rng.choice (length // 3, min (length // 3, struck), replace = False):
+            seq[codon * 3:codon * 3 + 3] = "---"
+        #end for
+        if rng.random () < truncated:
+            cut = rng.integers (1, length // 2)
+            seq[:cut] = "-" * cut
+        #end if
+        return "".join (seq)
+    #end nested method
+    background = [reference_seq]
+    while len (background) < n_background:
+        background.append (mutate (background[rng.integers (len (background))], distance * length * 2))
+    #end while
+    query = [mutate (background[rng.integers (len (background))], distance * length * rng.choice ((0.5, 1., 3.))) for q in range (n_query)]
+    return [damage (seq) for seq in query], [damage (seq) for seq in background]
+#end method
+
+def print_report (results):
+    print("| data | query | background | rows | exactly compared pairs | exhaustive pairs | excluded | recall | sketch s | exhaustive s |")
+    print("|:---:|:---:|:---:|:---:|:---:|:---:|:---:|:---:|:---:|:---:|")
+    for r in results:
+        print("| %s | %d | %d | %d | %d | %d | %d | %.4f | %.2f | %.2f |" % (r['label'], r['query'], r['background'], r['rows'], r['candidates'], r['exhaustive_pairs'], r['excluded'], r['recall'], r['sketch_seconds'], r['exhaustive_seconds']))
+    #end for
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Sketch prefilter recall check and benchmark against exhaustive TN93')
+    arguments.add_argument('-q', '--query',      help = 'Aligned query clusters (FASTA)',                   required = False, type = str)
+    arguments.add_argument('-b', '--background', help = 'Aligned background (FASTA)',                       required = False, type = str)
+    arguments.add_argument('-r', '--reference',  help = 'Bundled gene reference to evolve synthetic sets from', required = False, type = str, default = os.path.join ("data", "reference", "H3N2", "HA.fasta"))
+    arguments.add_argument('--benchmark',        help = 'Synthetic background sizes to benchmark',          required = False, type = int, nargs = '*')
+    arguments.add_argument('--n_query',          help = 'Synthetic query clusters',                         required = False, type = int, default = 500)
+    arguments.add_argument('--struck',           help = 'Struck (---) codons per synthetic sequence',       required = False, type = int, default = 3)
+    arguments.add_argument('--truncated',        help = 'Fraction of synthetic rows truncated at the 5\' end', required = False, type = float, default = 0.3)
+    arguments.add_argument('--threshold',        help = 'Exclusion threshold (combine.py uses 2 x threshold_query)', required = False, type = float, default = 0.001)
+    arguments.add_argument('-t', '--threads',    help = 'Threads for the exact comparisons',                required = False, type = int, default = 1)
+    settings = arguments.parse_args()
+
+    results = []
+    if settings.query and settings.background:
+        query_ids, query_seqs = tn93_engine.read_alignment (settings.query)
+        background_ids, background_seqs = tn93_engine.read_alignment (settings.background)
+        results.append (check_recall (query_seqs, background_seqs, settings.threshold, settings.threads, "files"))
+    else:
+        # clean rows, then struck codons, truncated rows and both
+        reference_seq = next (iter (tn93_engine.read_alignment (settings.reference)[1])).upper ()
+        scenarios = [("clean", 0, 0.), ("struck", settings.struck, 0.), ("truncated", 0, settings.truncated), ("struck+truncated", settings.struck, settings.truncated)]
+        for n in settings.benchmark or [10000]:
+            for label, struck, truncated in scenarios:
+                query_seqs, background_seqs = synthetic_sets (reference_seq, n, settings.n_query, settings.threshold, struck, truncated)
+                results.append (check_recall (query_seqs, background_seqs, settings.threshold, settings.threads, label))
+            #end for
+        #end for
+    #end if
+    print_report (results)
+    sys.exit(0 if all (r['recall'] == 1. for r in results) else 1)
+#end if
+
+# End of file
@@ -0,0 +1,139 @@
+# Stratified pre-alignment subsampling of a deduplicated background segment shard
+
+# Imports -------------------------------------------------------------
+import re
+import sys
+import heapq
+import hashlib
+import argparse
+from collections import defaultdict
+
+# Declares
+# cleaner.py turns ' ', '|', '/' and '-' into '_', so a GISAID header such as
+#   >A/Texas/50/2012|EPI_ISL_123456|2012-04-01
+# arrives as
+#   >A_Texas_50_2012_EPI_ISL_123456_2012_04_01
+_epi_isl = re.compile (r"(?:EPI_ISL_|epi_isl_)([0-9]+)")
+_date = re.compile (r"(?:^|_)((?:19|20)[0-9]{2})_([01][0-9])(?:_[0-3][0-9])?(?:_|$)")
+# location: strain-name tokens after the type, up to the isolate number
+_strain = re.compile (r"^(?:A|B)_(.+?)_[0-9]")
+
+UNKNOWN = "unknown"
+
+# Helper functions -----------------------------------------------------
+
+def header_strata (header):
+    # (location, year_month) from a cleaned header, UNKNOWN where absent
+    match = _strain.search (header)
+    location = match.group (1).lower () if match else UNKNOWN
+    dates = _date.findall (header)
+    # the collection date follows the strain name, take the last one present
+    year_month = "%s_%s" % dates[-1] if dates else UNKNOWN
+    return location, year_month
+#end method
+
+def priority (header):
+    # Deterministic sampling key: the EPI_ISL accession when there is one, so
+    # the same isolates are kept run to run (and stay in the alignment cache)
+    match = _epi_isl.search (header)
+    key = match.group (1) if match else header
+    return int.from_bytes (hashlib.blake2b (key.encode (), digest_size = 8).digest (), "big")
+#end method
+
+def scan_records (in_file, keep):
+    # One streaming pass; per stratum, the KEEP lowest priorities as
+    # (-priority, offset, length) max-heaps. Sequences are not held in memory.
+    strata = defaultdict (list)
+    total = 0
+    with open (in_file, "rb") as fh:
+        offset = 0
+        header = None
+        start = 0
+        def close (end):
+            stratum = header_strata (header)
+            entry = (-priority (header), start, end - start)
+            heap = strata[stratum]
+            if len (heap) < keep:
+                heapq.heappush (heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace (heap, entry)
+            #end if
+        #end nested method
+        for line in fh:
+            if line[:1] == b'>':
+                if header is not None:
+                    close (offset)
+                    total += 1
+                #end if
+                header = line[1:].decode (errors = "replace").strip ()
+                start = offset
+            #end if
+            offset += len (line)
+        #end for
+        if header is not None:
+            close (offset)
+            total += 1
+        #end if
+    #end with
+    return strata, total
+#end method
+
+def allocate (sizes, target):
+    # Equal quota per stratum, leftovers from small strata spread over the rest
+    quota = dict ((s, 0) for s in sizes)
+    remaining = target
+    open_strata = sorted (sizes, key = lambda s: sizes[s])
+    while open_strata and remaining > 0:
+        share = max (1, remaining // len (open_strata))
+        next_open = []
+        for s in open_strata:
+            take = min (share, sizes[s] - quota[s], remaining)
+            quota[s] += take
+            remaining -= take
+            if quota[s] < sizes[s]:
+                next_open.append (s)
+            #end if
+            if remaining == 0:
+                break
+            #end if
+        #end for
+        open_strata = next_open
+    #end while
+    return quota
+#end method
+
+def subsample (in_file, out_file, target):
+    strata, total = scan_records (in_file, target)
+    quota = allocate (dict ((s, len (h)) for s, h in strata.items ()), target)
+    selected = []
+    for s, heap in strata.items ():
+        # lowest priorities first
+        selected.extend (sorted (heap, reverse = True)[:quota[s]])
+    #end for
+    selected.sort (key = lambda e: e[1])
+    with open (in_file, "rb") as fh, open (out_file, "wb") as out:
+        for neg_priority, offset, length in selected:
+            fh.seek (offset)
+            out.write (fh.read (length))
+        #end for
+    #end with
+    return total, len (selected), len (strata)
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='Stratified (location x collection month) subsampling before alignment')
+    arguments.add_argument('-i', '--input',        help = 'Background segment shard (demux_segments.py output)',  required = True, type = str)
+    arguments.add_argument('-o', '--output',       help = 'Subsampled FASTA',                                     required = True, type = str)
+    arguments.add_argument('-m', '--max_retain',   help = 'max_background of the clustering stage (per gene)',    required = True, type = int)
+    arguments.add_argument('-f', '--factor',       help = 'Keep this multiple of --max_retain (0 copies everything)', required = False, type = float, default = 5.)
+    settings = arguments.parse_args()
+
+    target = int (settings.max_retain * settings.factor) if settings.factor > 0 else sys.maxsize
+    total, kept, n_strata = subsample (settings.input, settings.output, target)
+    print("# Kept %d of %d records across %d location/month strata" % (kept, total, n_strata))
+    sys.exit(0)
+#end if
+
+# End of file
@@ -8,6 +8,8 @@ import json
 import shutil
 import random
 
+from fasta_io import read_fasta
+
 # Declares
 # Argparse here
 arguments = argparse.ArgumentParser(description='Cluster an MSA with genetic distance (TN93)')
@@ -19,8 +21,21 @@ arguments.add_argument('--threshold',              help = 'Distance threshold fo
 #arguments.add_argument('--step',                   help = 'Distance threshold for clustering query sequences',    required = True, type = float)
 arguments.add_argument('-m', '--max_retain',    help = 'The maximum number of sequences to retain',               required = True, type = int)
 arguments.add_argument('-r', '--reference_seq',    help = 'The maximum number of sequences to retain',               required = False, type = str)
+arguments.add_argument('--multiplicity',           help = 'id/hash/count table written by dedup.py',                 required = False, type = str)
+arguments.add_argument('--engine',                 help = 'tn93-cluster subprocess or the in-process tn93_engine',   required = False, type = str, default = "tn93-cluster", choices = ["tn93-cluster", "native"])
+arguments.add_argument('--one-shot',               help = 'Build the neighbour graph once and bisect over the +25%% threshold steps (native engine)', action = 'store_true')
+arguments.add_argument('-t', '--threads',          help = 'Worker threads for the native engine',                   required = False, type = int, default = 1)
+arguments.add_argument('--mode',                   help = 'threshold: cluster at --threshold and raise it until --max_retain is met; kcenter: pick exactly --max_retain farthest-point representatives', required = False, type = str, default = "threshold", choices = ["threshold", "kcenter"])
+arguments.add_argument('--state',                  help = 'Cluster state kept across runs; new sequences join existing clusters (implies --one-shot)', required = False, type = str)
+arguments.add_argument('--distance_cache',         help = 'Per-gene distance cache directory shared with combine.py (one-shot native engine)', required = False, type = str)
+arguments.add_argument('--max_edges',              help = 'One-shot mode: recluster step by step instead when a neighbour graph would exceed this many edges', required = False, type = int, default = 20000000)
+arguments.add_argument('--stage',                  help = 'Stage name recorded with the distance cache hit rates',  required = False, type = str, default = "tn93_cluster")
 
 settings = arguments.parse_args()
+if settings.mode == "kcenter" and settings.engine != "native":
+    # tn93-cluster has no k-center selection; say so rather than switch engines
+    arguments.error ("--mode kcenter needs --engine native")
+#end if
 
 input_stamp = os.path.getmtime(settings.input)
 
@@ -41,6 +56,15 @@ if settings.reference_seq:
             
 print ("Reference seq_name %s" % _ref_seq_name)
 
+# Number of isolates behind every sequence id, carried through every pass so the
+# final cluster sizes count isolates rather than unique sequences
+cluster_sizes = {}
+if settings.multiplicity:
+    from dedup import load_multiplicity
+    cluster_sizes = load_multiplicity (settings.multiplicity)
+    print ("# Loaded multiplicities for %d unique sequences" % len (cluster_sizes))
+#end if
+
 # files
 cluster_json = settings.output_json          #output file # This is actually a json file
 compressed_fasta = settings.output_fasta           # .compressed.fas
@@ -70,50 +94,265 @@ def run_command (exec, arguments, filename, tag):
     return os.path.getmtime(filename)
 #end method
 
-def cluster_to_fasta (in_file, out_file, ref_seq = None):
+def run_native (in_file, out_file, threshold):
+    # Same clusters and json layout as tn93-cluster -f, without the subprocess
+    import tn93_engine
+
+    print("# tn93_engine greedy clustering of %s at threshold %g" % (in_file, threshold))
+    ids, seqs = tn93_engine.read_alignment (in_file)
+    centroids, members = tn93_engine.greedy_cluster (tn93_engine.encode (seqs), threshold)
+    tn93_engine.write_cluster_json (out_file, ids, seqs, centroids, members)
+    return os.path.getmtime(out_file)
+#end method
+
+def run_one_shot (in_file, out_file, threshold, max_retain, threads, steps = 8, cache = None, max_edges = None):
+    # Same threshold steps as the recluster loop (+25% each), but each pairwise
+    # graph covers several steps, and each step is a greedy pass over its edges;
+    # bisection finds the first step that retains few enough. The graph ceiling
+    # starts one step up and doubles (up to STEPS steps) while it is not enough,
+    # so dense sets do not start with the widest graph. Returns None when a
+    # graph would hold more than MAX_EDGES edges; the caller reclusters instead.
+    # With a DistanceCache, pairs from earlier runs are reused for the graph.
+    import numpy as np
+    import tn93_engine
+
+    ids, seqs = tn93_engine.read_alignment (in_file)
+    codes = tn93_engine.encode (seqs)
+    thresholds = [threshold]
+    clusterings = {}
+    lo = 0
+    width = 1
+    while True:
+        while len (thresholds) <= lo + width:
+            thresholds.append (thresholds[-1] * 1.25)
+        #end while
+        hi = lo + width
+        print("# tn93_engine neighbour graph of %s up to threshold %g" % (in_file, thresholds[hi]))
+        pairs = None
+        if cache:
+            table = np.array (cache.neighbors (seqs, seqs, thresholds[hi], symmetric = True, threads = threads, stage = settings.stage), dtype = np.float64).reshape (-1, 3)
+            pairs = [(table[:, 0].astype (np.int64), table[:, 1].astype (np.int64), table[:, 2])]
+        #end if
+        graph = tn93_engine.neighbor_graph (codes, thresholds[hi], threads, pairs = pairs, max_edges = max_edges)
+        if graph is None:
+            print("# More than %d edges up to threshold %g" % (max_edges, thresholds[hi]))
+            return None
+        #end if
+        print("# %d edges" % len (graph[1]))
+        clusterings.clear ()
+        clusterings[hi] = tn93_engine.greedy_cluster_graph (graph, thresholds[hi])
+        if len (clusterings[hi][0]) <= max_retain or len (clusterings[hi][0]) == 1:
+            break
+        #end if
+        lo = hi
+        width = min (2 * width, steps)
+    #end while
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        clusterings[mid] = clusterings.get (mid) or tn93_engine.greedy_cluster_graph (graph, thresholds[mid])
+        print("# Threshold %g: %d clusters" % (thresholds[mid], len (clusterings[mid][0])))
+        if len (clusterings[mid][0]) <= max_retain:
+            hi = mid
+        else:
+            lo = mid + 1
+        #end if
+    #end while
+
+    centroids, members = clusterings[hi]
+    tn93_engine.write_cluster_json (out_file, ids, seqs, centroids, members)
+    print("# Chose threshold %g with %d clusters" % (thresholds[hi], len (centroids)))
+    return thresholds[hi]
+#end method
+
+def run_kcenter (in_file, out_file, max_retain, ref_seq = None):
+    # Exactly max_retain representatives spanning the diversity, starting from
+    # the reference so it is always kept
+    import tn93_engine
+
+    ids, seqs = tn93_engine.read_alignment (in_file)
+    first = ids.index (ref_seq) if ref_seq in ids else 0
+    print("# tn93_engine k-center selection of %d from %d sequences, starting at %s" % (max_retain, len (ids), ids[first] if ids else None))
+    centroids, members = tn93_engine.farthest_point (tn93_engine.encode (seqs), max_retain, first)
+    return tn93_engine.write_cluster_json (out_file, ids, seqs, centroids, members)
+#end method
+
+def load_state (state_file):
+    # Clusters from the previous run, or None if there is nothing to reuse
+    if not state_file or not os.path.exists (state_file):
+        return None
+    #end if
+    with open (state_file) as fh:
+        state = json.load (fh)
+    #end with
+    if state.get ('base_threshold') != settings.threshold or state.get ('max_retain') != settings.max_retain:
+        print("# Cluster state %s was built with threshold %g / max_retain %d, reclustering" % (state_file, state.get ('base_threshold', -1), state.get ('max_retain', -1)))
+        return None
+    #end if
+    return state
+#end method
+
+def save_state (state_file, cluster_file, threshold, sites):
+    from cluster_json import iter_clusters, centroid_record
+
+    clusters = [{'centroid': centroid_record (c)[0][1:], 'members': c['members']} for c in iter_clusters (cluster_file)]
+    tmp_file = state_file + ".tmp"
+    with open (tmp_file, "w") as fh:
+        json.dump ({'base_threshold': settings.threshold, 'max_retain': settings.max_retain, 'threshold': threshold, 'sites': sites, 'clusters': clusters}, fh)
+    #end with
+    os.replace (tmp_file, state_file)
+#end method
+
+def run_incremental (in_file, out_file, state):
+    # Keep last run's clusters: drop sequences that are gone, then put the old
+    # centroids first and the new sequences after them through the same greedy
+    # pass at the stored threshold. Old centroids are further apart than the
+    # threshold, so they stay centroids and keep their members.
+    import tn93_engine
+    from cluster_json import ClusterWriter
+
+    ids, seqs = tn93_engine.read_alignment (in_file)
+    if seqs and len (seqs[0]) != state['sites']:
+        print("# Alignment width changed from %d to %d, reclustering" % (state['sites'], len (seqs[0])))
+        return None
+    #end if
+    index = dict ((seq_id, i) for i, seq_id in enumerate (ids))
+    clusters = [c for c in state['clusters'] if c['centroid'] in index]
+    known = set ()
+    for c in clusters:
+        c['members'] = [m for m in c['members'] if m in index]
+        known.update (c['members'])
+    #end for
+    new = [i for i, seq_id in enumerate (ids) if seq_id not in known]
+    print("# Cluster state: %d clusters kept, %d of %d sequences new at threshold %g" % (len (clusters), len (new), len (ids), state['threshold']))
+
+    order = [index[c['centroid']] for c in clusters] + new
+    centroids, members = tn93_engine.greedy_cluster (tn93_engine.encode ([seqs[i] for i in order]), state['threshold'])
+    with ClusterWriter (out_file) as out:
+        for c, mem in zip (centroids, members):
+            names = []
+            for m in mem:
+                names.extend (clusters[m]['members'] if m < len (clusters) else [ids[order[m]]])
+            #end for
+            out.write ({'centroid': ">%s\n%s" % (ids[order[c]], seqs[order[c]]), 'members': names})
+        #end for
+    #end with
+    return len (centroids), len (seqs[0]) if seqs else 0
+#end method
+
+def cluster_to_fasta (in_file, out_file, ref_seq = None, sizes = None):
     # assert that in_file exists, otherwise this will crash if tn93-cluster did not run.
+    # Clusters are streamed one at a time, so memory stays bounded by the
+    # largest cluster rather than the whole json.
+    from cluster_json import iter_clusters, ClusterWriter, CompactIdSet, centroid_record
 
-    with open (in_file, "r") as fh:
-        cluster_json = json.load (fh)
-        #print (colored('Running ... converting representative clusters to .FASTA\n', 'cyan'))
-        check_uniq = set ()
-        print("# Saving to fasta:", out_file)
-        with open (out_file, "w") as fh2:
-            for c in cluster_json:
-                cc = c['centroid'].split ('\n')
-                if ref_seq:
-                    if ref_seq in c['members']:
-                        cc[0] = ">" + ref_seq
-                        print ("\n".join (cc), file = fh2)
-                        continue
-                    #end if
+    check_uniq = CompactIdSet ()
+    next_sizes = {}
+    cluster_count = 0
+    rewritten = ClusterWriter (in_file + ".tmp") if sizes is not None else None
+    print("# Saving to fasta:", out_file)
+    with open (out_file, "w") as fh2:
+        for c in iter_clusters (in_file):
+            cluster_count += 1
+            header, seq = centroid_record (c)
+            if sizes is not None:
+                c['size'] = sum (sizes.get (m, 1) for m in c['members'])
+                rewritten.write (c)
+            #end if
+            if ref_seq:
+                if ref_seq in c['members']:
+                    print (">" + ref_seq + "\n" + seq, file = fh2)
+                    next_sizes[ref_seq] = c.get ('size', 1)
+                    continue
                 #end if
-                seq_id = cc[0]
-                while seq_id in check_uniq:
-                        seq_id = cc[0] + '_' + ''.join(random.choices ('0123456789abcdef', k = 10))
-                #end while
-                check_uniq.add (seq_id)
-                #print (seq_id,"\n",cc[1], file = fh2)
-                print (seq_id + "\n" + cc[1].replace(" ", "") + "\n", file = fh2)
-            #end for
-         #end with
+            #end if
+            seq_id = header
+            while seq_id in check_uniq:
+                    seq_id = header + '_' + ''.join(random.choices ('0123456789abcdef', k = 10))
+            #end while
+            check_uniq.add (seq_id)
+            next_sizes[seq_id[1:]] = c.get ('size', 1)
+            print (seq_id + "\n" + seq + "\n", file = fh2)
+        #end for
     #end with
-    return (os.path.getmtime(out_file), len(cluster_json))
+    if sizes is not None:
+        # Record isolate counts in the cluster json and carry them to the next pass
+        rewritten.close ()
+        os.replace (in_file + ".tmp", in_file)
+        sizes.clear ()
+        sizes.update (next_sizes)
+    #end if
+    return (os.path.getmtime(out_file), cluster_count)
 #end method
 
 # Main subroutine -----------------------------------------------------
 
 input_file = msa_strike_ambigs
 
+if settings.mode == "kcenter":
+    run_kcenter (input_file, cluster_json, max_toRetain, _ref_seq_name)
+    if _ref_seq_name != "":
+        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, _ref_seq_name, cluster_sizes)
+    else:
+        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, sizes = cluster_sizes)
+    #end if
+    print("# Current number of sequences", cluster_count)
+    print("# Isolates represented", sum (cluster_sizes.values()))
+    sys.exit(0)
+#end if
+
+if settings.one_shot or settings.state:
+    state = load_state (settings.state)
+    incremental = run_incremental (input_file, cluster_json, state) if state else None
+    if incremental and incremental[0] <= max_toRetain:
+        threshold = chosen = state['threshold']
+        sites = incremental[1]
+        print("# Updated %d clusters in place at threshold %g" % (incremental[0], threshold))
+    else:
+        if incremental:
+            print("# %d clusters exceed %d, reclustering" % (incremental[0], max_toRetain))
+        #end if
+        cache = None
+        if settings.distance_cache:
+            from distance_cache import DistanceCache
+            cache = DistanceCache (settings.distance_cache)
+        #end if
+        chosen = run_one_shot (input_file, cluster_json, threshold, max_toRetain, settings.threads, cache = cache, max_edges = settings.max_edges)
+        sites = len (next (read_fasta (input_file), ('', ''))[1])
+    #end if
+    if chosen is not None:
+        threshold = chosen
+        if settings.state:
+            save_state (settings.state, cluster_json, threshold, sites)
+        #end if
+        if _ref_seq_name != "":
+            input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, _ref_seq_name, cluster_sizes)
+        else:
+            input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, sizes = cluster_sizes)
+        #end if
+        print("# Current number of sequences", cluster_count)
+        print("# Isolates represented", sum (cluster_sizes.values()))
+        sys.exit(0)
+    #end if
+    # the graph is too dense: recluster pass by pass below; the passes cluster
+    # earlier centroids, so there is no per-sequence state to keep this run
+    print("# Falling back to the recluster loop")
+#end if
+
 while True:
-    input_stamp = run_command (task_runners['tn93-cluster'], ['-f', '-o', cluster_json, '-t', "%g" % threshold, input_file], cluster_json, "extract representative clusters at threshold %g" % threshold)    
+    if settings.engine == "native":
+        input_stamp = run_native (input_file, cluster_json, threshold)
+    else:
+        input_stamp = run_command (task_runners['tn93-cluster'], ['-f', '-o', cluster_json, '-t', "%g" % threshold, input_file], cluster_json, "extract representative clusters at threshold %g" % threshold)    
+    #end if
     if _ref_seq_name != "":
-        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, _ref_seq_name)
+        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, _ref_seq_name, cluster_sizes)
     else:
-        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta) # changes the json to fasta, also returns the count len().
+        input_stamp, cluster_count = cluster_to_fasta (cluster_json, compressed_fasta, sizes = cluster_sizes) # changes the json to fasta, also returns the count len().
     #end if
     
     print("# Current number of sequences", cluster_count)
+    print("# Isolates represented", sum (cluster_sizes.values()))
     if cluster_count <= max_toRetain:
         #shutil.copy (msa_SA, msa)
         break
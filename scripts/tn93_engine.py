@@ -0,0 +1,423 @@
+# In-process TN93 distances on aligned sequences (NumPy)
+
+# Imports -------------------------------------------------------------
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fasta_io import read_fasta
+
+# Declares
+# 4-bit nucleotide codes (A, C, G, T = 1, 2, 4, 8), IUPAC ambiguities are the
+# union of their resolutions, gaps and unknown characters are 0 (skipped)
+_iupac = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+          'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+          'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+_code_lut = np.zeros (256, dtype = np.uint8)
+for _c, _bases in _iupac.items ():
+    _code = sum (1 << "ACGT".index (b) for b in _bases)
+    _code_lut[ord (_c)] = _code
+    _code_lut[ord (_c.lower ())] = _code
+#end for
+
+# Same defaults as the tn93 command line tool
+MIN_OVERLAP = 100
+AMBIGUITY_MODES = ("resolve", "average")
+
+# Rows per block in the pairwise kernels
+BLOCK_SIZE = 512
+
+# Helper functions -----------------------------------------------------
+
+def read_alignment (filename):
+    ids, seqs = [], []
+    for seq_id, seq in read_fasta (filename):
+        ids.append (seq_id)
+        seqs.append (seq)
+    #end for
+    return ids, seqs
+#end method
+
+def encode (seqs):
+    # (n_seqs x n_sites) uint8 array of 4-bit nucleotide codes
+    if not seqs:
+        return np.zeros ((0, 0), dtype = np.uint8)
+    #end if
+    length = max (len (s) for s in seqs)
+    padded = "".join (s.ljust (length, '-') for s in seqs)
+    return _code_lut[np.frombuffer (padded.encode (), dtype = np.uint8)].reshape (len (seqs), length)
+#end method
+
+def _resolution_weights ():
+    # Fraction of a position assigned to each base ("average" semantics)
+    weights = np.zeros ((16, 4), dtype = np.float32)
+    for code in range (1, 16):
+        bases = [b for b in range (4) if code & (1 << b)]
+        weights[code, bases] = 1. / len (bases)
+    #end for
+    return weights
+#end method
+
+_weights = _resolution_weights ()
+
+def _pair_table (mode):
+    # 4x4 nucleotide pair counts contributed by each (code_a, code_b)
+    table = np.zeros ((16, 16, 4, 4), dtype = np.float32)
+    for a in range (1, 16):
+        for b in range (1, 16):
+            shared = a & b
+            if mode == "resolve" and shared:
+                w = _weights[shared]
+                table[a, b] = np.diag (w)
+            else:
+                table[a, b] = np.outer (_weights[a], _weights[b])
+            #end if
+        #end for
+    #end for
+    return table.reshape (256, 16)
+#end method
+
+_pair_tables = {mode: _pair_table (mode) for mode in AMBIGUITY_MODES}
+
+# What "resolve" changes relative to the averaged one-hot products, non-zero
+# only where at least one of the two codes is ambiguous
+_resolve_delta = _pair_tables["resolve"] - _pair_tables["average"]
+
+def _is_ambiguous (codes):
+    return (codes != 0) & (codes != 1) & (codes != 2) & (codes != 4) & (codes != 8)
+#end method
+
+def pair_counts (a, b, mode = "resolve"):
+    # (n_a x n_b x 16) nucleotide pair counts, 16 = 4 * base in a + base in b.
+    # All positions go through 16 matrix products on averaged one-hot weights,
+    # then "resolve" is applied as a correction at ambiguous positions only.
+    wa = _weights[a]
+    wb = _weights[b]
+    counts = np.empty ((a.shape[0], b.shape[0], 16), dtype = np.float32)
+    for x in range (4):
+        for y in range (4):
+            counts[:, :, 4 * x + y] = wa[:, :, x] @ wb[:, :, y].T
+        #end for
+    #end for
+    if mode == "resolve":
+        amb_a = _is_ambiguous (a)
+        amb_b = _is_ambiguous (b)
+        for i in np.nonzero (amb_a.any (axis = 1))[0]:
+            cols = np.nonzero (amb_a[i])[0]
+            counts[i] += _resolve_delta[(a[i, cols].astype (np.int32) << 4) | b[:, cols]].sum (axis = 1)
+        #end for
+        for j in np.nonzero (amb_b.any (axis = 1))[0]:
+            cols = np.nonzero (amb_b[j])[0]
+            # positions ambiguous in a were corrected in the pass above
+            delta = _resolve_delta[(a[:, cols].astype (np.int32) << 4) | b[j, cols]]
+            delta[amb_a[:, cols]] = 0.
+            counts[:, j] += delta.sum (axis = 1)
+        #end for
+    #end if
+    return counts
+#end method
+
+def tn93_from_counts (counts, min_overlap = MIN_OVERLAP):
+    # Tamura-Nei 1993 distance from (..., 16) pair counts; nan when the
+    # overlap is too short, inf when the distance is saturated
+    c = counts.reshape (counts.shape[:-1] + (4, 4)).astype (np.float64)
+    total = c.sum (axis = (-2, -1))
+    with np.errstate (divide = 'ignore', invalid = 'ignore'):
+        freqs = (c.sum (axis = -1) + c.sum (axis = -2)) / (2 * total[..., None])
+        gA, gC, gG, gT = freqs[..., 0], freqs[..., 1], freqs[..., 2], freqs[..., 3]
+        gR = gA + gG
+        gY = gC + gT
+        P1 = (c[..., 0, 2] + c[..., 2, 0]) / total
+        P2 = (c[..., 1, 3] + c[..., 3, 1]) / total
+        Q = 1. - (np.trace (c, axis1 = -2, axis2 = -1) / total) - P1 - P2
+        d = - 2. * gA * gG / gR * np.log (1. - gR * P1 / (2. * gA * gG) - Q / (2. * gR)) \
+            - 2. * gC * gT / gY * np.log (1. - gY * P2 / (2. * gC * gT) - Q / (2. * gY)) \
+            - 2. * (gR * gY - gA * gG * gY / gR - gC * gT * gR / gY) * np.log (1. - Q / (2. * gR * gY))
+    #end with
+    identical = (P1 + P2 + Q) <= 0.
+    d = np.where (identical, 0., d)
+    d = np.where (np.isfinite (d) | identical, d, np.inf)
+    return np.where (total >= min_overlap, d, np.nan)
+#end method
+
+def distances (a, b, mode = "resolve", min_overlap = MIN_OVERLAP):
+    return tn93_from_counts (pair_counts (a, b, mode), min_overlap)
+#end method
+
+def paired_distances (a, b, mode = "resolve", min_overlap = MIN_OVERLAP, block = 4096):
+    # Distance between a[p] and b[p] for every row p (candidate pair lists)
+    result = np.empty (a.shape[0], dtype = np.float64)
+    for s, e in _blocks (a.shape[0], block):
+        pair_index = (a[s:e].astype (np.int32) << 4) | b[s:e]
+        pair_index += (np.arange (e - s, dtype = np.int32) * 256)[:, None]
+        histogram = np.bincount (pair_index.ravel (), minlength = (e - s) * 256).reshape (e - s, 256)
+        result[s:e] = tn93_from_counts (histogram.astype (np.float32) @ _pair_tables[mode], min_overlap)
+    #end for
+    return result
+#end method
+
+def _blocks (n, size = BLOCK_SIZE):
+    return [(s, min (s + size, n)) for s in range (0, n, size)]
+#end method
+
+def neighbor_blocks (a, b, threshold, threads = 1, mode = "resolve", min_overlap = MIN_OVERLAP, symmetric = False):
+    # (i, j, d) arrays of the pairs with d <= threshold, one per block pair,
+    # blocked over both inputs and spread over threads (NumPy releases the GIL
+    # in the kernels). With symmetric = True, a and b are the same alignment
+    # and only pairs i < j are reported. Blocks are handed out a few per
+    # thread at a time, so a consumer that stops early stops the work too.
+    def run (block):
+        (i0, i1), (j0, j1) = block
+        d = distances (a[i0:i1], b[j0:j1], mode, min_overlap)
+        hits = d <= threshold
+        if symmetric:
+            hits &= (np.arange (i0, i1)[:, None] < np.arange (j0, j1)[None, :])
+        #end if
+        ii, jj = np.nonzero (hits)
+        return ii + i0, jj + j0, d[ii, jj]
+    #end nested method
+
+    work = [(bi, bj) for bi in _blocks (a.shape[0]) for bj in _blocks (b.shape[0]) if not symmetric or bj[1] > bi[0]]
+    window = 4 * max (1, threads)
+    with ThreadPoolExecutor (max_workers = max (1, threads)) as pool:
+        for s in range (0, len (work), window):
+            for result in pool.map (run, work[s:s + window]):
+                yield result
+            #end for
+        #end for
+    #end with
+#end method
+
+def neighbors (a, b, threshold, threads = 1, mode = "resolve", min_overlap = MIN_OVERLAP, symmetric = False):
+    # All (i, j, d) with d <= threshold, one pair at a time (see neighbor_blocks)
+    for ii, jj, dd in neighbor_blocks (a, b, threshold, threads, mode, min_overlap, symmetric):
+        for i, j, d in zip (ii.tolist (), jj.tolist (), dd.tolist ()):
+            yield i, j, d
+        #end for
+    #end for
+#end method
+
+def greedy_cluster (codes, threshold, mode = "resolve", min_overlap = MIN_OVERLAP, block = BLOCK_SIZE):
+    # tn93-cluster -f: sequences are visited in input order and join the first
+    # cluster whose centroid is within threshold, or seed a new cluster
+    centroids = []
+    members = []
+    for s, e in _blocks (codes.shape[0], block):
+        existing = len (centroids)
+        to_existing = distances (codes[s:e], codes[centroids], mode, min_overlap) if existing else None
+        within = distances (codes[s:e], codes[s:e], mode, min_overlap)
+        for t in range (e - s):
+            hit = None
+            if existing:
+                close = np.nonzero (to_existing[t] <= threshold)[0]
+                if len (close):
+                    hit = close[0]
+                #end if
+            #end if
+            if hit is None:
+                for k in range (existing, len (centroids)):
+                    if within[t, centroids[k] - s] <= threshold:
+                        hit = k
+                        break
+                    #end if
+                #end for
+            #end if
+            if hit is None:
+                centroids.append (s + t)
+                members.append ([s + t])
+            else:
+                members[hit].append (s + t)
+            #end if
+        #end for
+    #end for
+    return centroids, members
+#end method
+
+def _bases (codes):
+    # 0/1 membership of A, C, G, T in each code, as float32 (n x sites x 4)
+    return ((codes[:, :, None] >> np.arange (4, dtype = np.uint8)) & 1).astype (np.float32)
+#end method
+
+def mismatch_lower_bound (a, b):
+    # Fraction of shared sites where no resolution of the two codes agrees. TN93
+    # is never below the p-distance (-ln (1 - x) >= x term by term) and this is
+    # never above it, so pairs over threshold here can be skipped. 5 matrix
+    # products instead of the 16 of pair_counts.
+    ia, ib = _bases (a), _bases (b)
+    compatible = sum (ia[:, :, x] @ ib[:, :, x].T for x in range (4))
+    shared = (a != 0).astype (np.float32) @ (b != 0).astype (np.float32).T
+    with np.errstate (divide = 'ignore', invalid = 'ignore'):
+        return np.where (shared > 0, 1. - np.minimum (compatible, shared) / shared, 0.), shared
+    #end with
+#end method
+
+def any_neighbor (a, b, threshold, threads = 1, mode = "resolve", min_overlap = MIN_OVERLAP, block = BLOCK_SIZE, query_block = 128):
+    # Boolean mask over b: has at least one sequence of a within threshold. Rows
+    # of b stop being compared after the first query block that matches them,
+    # and exact TN93 only runs on pairs that pass the p-distance bound.
+    def run (span):
+        j0, j1 = span
+        found = np.zeros (j1 - j0, dtype = bool)
+        for i0, i1 in _blocks (a.shape[0], query_block):
+            open_rows = np.nonzero (~found)[0]
+            if len (open_rows) == 0:
+                break
+            #end if
+            bound, shared = mismatch_lower_bound (a[i0:i1], b[j0 + open_rows])
+            ii, jj = np.nonzero ((bound <= threshold) & (shared >= min_overlap))
+            if len (ii):
+                d = paired_distances (a[i0 + ii], b[j0 + open_rows[jj]], mode, min_overlap)
+                found[open_rows[jj[d <= threshold]]] = True
+            #end if
+        #end for
+        return found
+    #end nested method
+
+    with ThreadPoolExecutor (max_workers = max (1, threads)) as pool:
+        return np.concatenate ([np.zeros (0, dtype = bool)] + list (pool.map (run, _blocks (b.shape[0], block))))
+    #end with
+#end method
+
+def neighbor_graph (codes, threshold, threads = 1, mode = "resolve", min_overlap = MIN_OVERLAP, pairs = None, max_edges = None):
+    # Pairs within threshold as CSR over the later sequence of each pair:
+    # row i lists the earlier sequences j < i, in increasing j. PAIRS, when
+    # given (e.g. from a distance cache), replaces the symmetric neighbor_blocks
+    # pass; either way edges arrive as (i, j, d) array blocks with i < j.
+    # Returns None as soon as there are more than MAX_EDGES edges.
+    blocks = pairs if pairs is not None else neighbor_blocks (codes, codes, threshold, threads, mode, min_overlap, symmetric = True)
+    rows, cols, dists = [], [], []
+    edges = 0
+    for ii, jj, dd in blocks:
+        edges += len (ii)
+        if max_edges is not None and edges > max_edges:
+            if hasattr (blocks, "close"):
+                blocks.close ()
+            #end if
+            return None
+        #end if
+        rows.append (np.asarray (jj, dtype = np.int32))
+        cols.append (np.asarray (ii, dtype = np.int32))
+        dists.append (np.asarray (dd, dtype = np.float64))
+    #end for
+    rows = np.concatenate (rows + [np.zeros (0, dtype = np.int32)])
+    cols = np.concatenate (cols + [np.zeros (0, dtype = np.int32)])
+    dists = np.concatenate (dists + [np.zeros (0)])
+    order = np.lexsort ((cols, rows))
+    indptr = np.zeros (codes.shape[0] + 1, dtype = np.int64)
+    np.cumsum (np.bincount (rows, minlength = codes.shape[0]), out = indptr[1:])
+    return indptr, cols[order], dists[order]
+#end method
+
+def greedy_cluster_graph (graph, threshold):
+    # greedy_cluster on a precomputed neighbor_graph, for any threshold up to
+    # the one the graph was built with
+    indptr, cols, dists = graph
+    n = len (indptr) - 1
+    is_centroid = np.zeros (n, dtype = bool)
+    cluster_of = np.full (n, -1, dtype = np.int64)
+    centroids = []
+    members = []
+    for i in range (n):
+        nbrs = cols[indptr[i]:indptr[i + 1]]
+        close = nbrs[(dists[indptr[i]:indptr[i + 1]] <= threshold) & is_centroid[nbrs]]
+        if len (close):
+            k = cluster_of[close[0]]
+            members[k].append (i)
+        else:
+            is_centroid[i] = True
+            cluster_of[i] = len (centroids)
+            centroids.append (i)
+            members.append ([i])
+        #end if
+    #end for
+    return centroids, members
+#end method
+
+def farthest_point (codes, k, first = 0, mode = "resolve", min_overlap = MIN_OVERLAP):
+    # Greedy k-center: start from FIRST, then repeatedly add the sequence
+    # farthest from everything selected so far. One distance row per selected
+    # centroid (O(n k)), computed in blocks; each sequence ends up in its nearest
+    # centroid's cluster. Pairs with too little overlap to compare are skipped:
+    # they neither assign the sequence nor make it look far, and sequences no
+    # centroid can be compared with stay in the first cluster.
+    n = codes.shape[0]
+    nearest = np.zeros (n, dtype = np.int64)
+    closest = np.full (n, np.inf)
+    compared = np.zeros (n, dtype = bool)
+    d = np.empty (n)
+    centroids = []
+    c = first
+    while n and len (centroids) < min (k, n):
+        for s, e in _blocks (n):
+            d[s:e] = distances (codes[c:c + 1], codes[s:e], mode, min_overlap)[0]
+        #end for
+        d[c] = 0.
+        closer = d < closest
+        nearest[closer] = len (centroids)
+        closest[closer] = d[closer]
+        compared |= ~np.isnan (d)
+        centroids.append (c)
+        spread = np.where (compared, closest, 0.)
+        c = int (np.argmax (spread))
+        if spread[c] <= 0.:
+            # everything left is identical to a centroid, or not comparable
+            break
+        #end if
+    #end while
+    members = [[] for c in centroids]
+    for i, k in enumerate (nearest.tolist ()):
+        members[k].append (i)
+    #end for
+    return centroids, members
+#end method
+
+def write_cluster_json (filename, ids, seqs, centroids, members):
+    # Same layout as tn93-cluster output
+    import json
+
+    clusters = [{'centroid': ">%s\n%s" % (ids[c], seqs[c]), 'members': [ids[m] for m in mem]} for c, mem in zip (centroids, members)]
+    with open (filename, "w") as fh:
+        json.dump (clusters, fh)
+    #end with
+    return len (clusters)
+#end method
+
+# Main subroutine -----------------------------------------------------
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description='TN93 distances below a threshold (tn93 -t replacement)')
+    arguments.add_argument('-i', '--input',     help = 'Aligned FASTA',                                      required = True, type = str)
+    arguments.add_argument('-s', '--second',    help = 'Compare --input against this aligned FASTA instead', required = False, type = str)
+    arguments.add_argument('-t', '--threshold', help = 'Distance threshold',                                 required = False, type = float, default = 0.015)
+    arguments.add_argument('-a', '--ambigs',    help = 'Ambiguity handling',                                 required = False, type = str, default = "resolve", choices = AMBIGUITY_MODES)
+    arguments.add_argument('-l', '--overlap',   help = 'Minimum overlap',                                    required = False, type = int, default = MIN_OVERLAP)
+    arguments.add_argument('-n', '--threads',   help = 'Worker threads',                                     required = False, type = int, default = 1)
+    arguments.add_argument('-o', '--output',    help = 'Write ID1,ID2,Distance CSV here',                    required = True, type = str)
+    settings = arguments.parse_args()
+
+    start = time.perf_counter ()
+    ids_a, seqs_a = read_alignment (settings.input)
+    codes_a = encode (seqs_a)
+    if settings.second:
+        ids_b, seqs_b = read_alignment (settings.second)
+        codes_b = encode (seqs_b)
+    else:
+        ids_b, codes_b = ids_a, codes_a
+    #end if
+
+    found = 0
+    with open (settings.output, "w") as fh:
+        print ("ID1,ID2,Distance", file = fh)
+        for i, j, d in neighbors (codes_a, codes_b, settings.threshold, settings.threads, settings.ambigs, settings.overlap, symmetric = not settings.second):
+            print ("%s,%s,%g" % (ids_a[i], ids_b[j], d), file = fh)
+            found += 1
+        #end for
+    #end with
+    print("# %d pairs within %g in %.2fs" % (found, settings.threshold, time.perf_counter () - start))
+    sys.exit(0)
+#end if
+
+# End of file